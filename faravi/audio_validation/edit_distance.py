@@ -0,0 +1,84 @@
+from typing import Dict, Hashable, List, Sequence
+import numpy as np
+
+# Pairs compared together, sorted by length so a batch pads little
+BATCH_SIZE = 1024
+
+
+def encode(sequences: Sequence[Sequence[Hashable]], vocabulary: Dict[Hashable, int]) -> List[np.ndarray]:
+    """
+    Maps the tokens of every sequence, e.g. the words or characters of a
+    text, to integer ids shared through vocabulary.
+    """
+    return [
+        np.fromiter((vocabulary.setdefault(token, len(vocabulary)) for token in sequence),
+                    dtype=np.int32, count=len(sequence))
+        for sequence in sequences
+    ]
+
+def _pad(sequences: List[np.ndarray], fill: int) -> np.ndarray:
+    padded = np.full((len(sequences), max(len(s) for s in sequences)), fill, dtype=np.int32)
+    for i, sequence in enumerate(sequences):
+        padded[i, :len(sequence)] = sequence
+    return padded
+
+def _batch_distances(references: List[np.ndarray], hypotheses: List[np.ndarray]) -> np.ndarray:
+    """
+    Levenshtein distance of every reference to its hypothesis. The dynamic
+    programming runs over the reference positions, each step is vectorized
+    over the whole batch and all hypothesis positions: insertions are
+    resolved with a running minimum instead of a loop over the row.
+    """
+    ref_lengths = np.array([len(s) for s in references])
+    hyp_lengths = np.array([len(s) for s in hypotheses])
+    batch = np.arange(len(references))
+    # padding ids differ from each other and from all tokens
+    ref = _pad(references, -1)
+    hyp = _pad(hypotheses, -2)
+
+    columns = np.arange(hyp.shape[1] + 1)
+    row = np.broadcast_to(columns, (len(references), len(columns))).copy()
+    distances = row[batch, hyp_lengths].copy()
+
+    for i in range(1, ref.shape[1] + 1):
+        substitution = row[:, :-1] + (ref[:, i - 1, None] != hyp)
+        best = np.empty_like(row)
+        best[:, 0] = i
+        best[:, 1:] = np.minimum(row[:, 1:] + 1, substitution)
+        # best[j] = min over k <= j of best[k] + (j - k)
+        row = np.minimum.accumulate(best - columns, axis=1) + columns
+
+        done = ref_lengths == i
+        distances[done] = row[done, hyp_lengths[done]]
+
+    return distances
+
+def edit_distances(references: Sequence[Sequence[Hashable]], hypotheses: Sequence[Sequence[Hashable]],
+                   batch_size: int = BATCH_SIZE) -> np.ndarray:
+    """
+    Levenshtein distances of many pairs of token sequences at once. Pass
+    strings to compare characters, or lists of words to compare words.
+    """
+    if len(references) != len(hypotheses):
+        raise ValueError(f"Got {len(references)} references but {len(hypotheses)} hypotheses")
+
+    vocabulary: Dict[Hashable, int] = {}
+    references = encode(references, vocabulary)
+    hypotheses = encode(hypotheses, vocabulary)
+
+    distances = np.zeros(len(references), dtype=np.int64)
+    order = np.argsort([len(r) + len(h) for r, h in zip(references, hypotheses)], kind='stable')
+    for first in range(0, len(order), batch_size):
+        indices = order[first:first + batch_size]
+        distances[indices] = _batch_distances([references[i] for i in indices],
+                                              [hypotheses[i] for i in indices])
+    return distances
+
+def error_rates(references: Sequence[Sequence[Hashable]], hypotheses: Sequence[Sequence[Hashable]],
+                batch_size: int = BATCH_SIZE) -> np.ndarray:
+    """
+    Edit distances divided by the reference lengths: WER for word lists,
+    CER for strings. An empty reference counts as one token.
+    """
+    lengths = np.array([max(len(r), 1) for r in references])
+    return edit_distances(references, hypotheses, batch_size) / lengths
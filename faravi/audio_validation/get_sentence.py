@@ -1,37 +1,88 @@
 import ast
-from glob import glob
-import sys
-from editdistpy import levenshtein
+import re
+from concurrent.futures import ProcessPoolExecutor
+from os.path import basename, splitext
+from typing import Dict, List, Sequence
+from faravi.audio_validation.edit_distance import edit_distances
 
-def distance(s1, s2):
-    return levenshtein.distance(s1, s2, sys.maxsize)
+try:
+    from orjson import loads as _loads, JSONDecodeError
+except ImportError:
+    from json import loads as _loads, JSONDecodeError
 
-def get_sentence(filename):
-    with open(filename, 'r') as f:
-        dictionary = ast.literal_eval(f.read())
+# Attached to the previous word instead of starting a new one
+PUNCTUATION = {'.', ',', '!', '?', '؟', '،', '؛'}
+
+# Results of the ASR service as written by repr(): a content string in single
+# quotes, or double quotes when it contains a single quote
+CONTENT = re.compile(r"""'content': (?:'([^'\\]*)'|"([^"\\]*)")""")
+ALTERNATIVES = re.compile(r"'alternatives': \[")
+
+
+def distance(s1, s2):
+    return int(edit_distances([s1], [s2])[0])
 
-    sentence = ''
-    for r in dictionary['results']:
+def _words_from_results(results: list) -> List[str]:
+    words = []
+    for r in results:
         if len(r['alternatives']) != 1:
             raise Exception(f'Unexpected number of alternatives: {r}')
-        
-        content = r['alternatives'][0]['content']
+        words.append(r['alternatives'][0]['content'])
+    return words
+
+def parse_words(text: str) -> List[str]:
+    """
+    Returns the recognized words and punctuation of an ASR result, either
+    JSON or a Python dict literal. Literals are scanned with a regex and only
+    evaluated with literal_eval if the scan is not conclusive, e.g. for
+    escaped quotes or more than one alternative.
+    """
+    try:
+        return _words_from_results(_loads(text)['results'])
+    except JSONDecodeError:
+        pass
+
+    results = text[text.find("'results': ["):]
+    matches = CONTENT.findall(results)
+    if len(matches) == len(ALTERNATIVES.findall(results)):
+        return [single or double for single, double in matches]
+    return _words_from_results(ast.literal_eval(text)['results'])
+
+def join_words(words: Sequence[str]) -> str:
+    pieces = []
+    for word in words:
+        if pieces and word not in PUNCTUATION:
+            pieces.append(' ')
+        pieces.append(word)
+    return ''.join(pieces)
+
+def get_sentence(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        return join_words(parse_words(f.read()))
 
-        if r in ['.', ',', '!', '?', '؟']:
-            sentence += content
-        else:
-            sentence += ' ' + content
+def load_hypotheses(filenames: Sequence[str], workers: int = 1) -> Dict[str, str]:
+    """
+    Reads many ASR results, keyed by the file name without its extension,
+    which is the name of the audio chunk they transcribe.
+    """
+    keys = [splitext(basename(filename))[0] for filename in filenames]
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            sentences = list(pool.map(get_sentence, filenames, chunksize=64))
+    else:
+        sentences = [get_sentence(filename) for filename in filenames]
+    return dict(zip(keys, sentences))
 
-    return sentence
 
-# json_files = glob('/home/srezas/Programming/projects/farsi-asr-dataset/samples/sm/*.json')
-# json_files = sorted(json_files)
+if __name__ == '__main__':
+    # json_files = glob('/home/srezas/Programming/projects/farsi-asr-dataset/samples/sm/*.json')
+    # json_files = sorted(json_files)
 
-# sentences = []
-# for json_file in json_files:
-#     sentences.append(get_sentence(json_file))
+    # sentences = []
+    # for json_file in json_files:
+    #     sentences.append(get_sentence(json_file))
 
-sentence = get_sentence('/home/srezas/Programming/projects/farsi-asr-dataset/audio_validation/virgool.json')
+    sentence = get_sentence('/home/srezas/Programming/projects/farsi-asr-dataset/audio_validation/virgool.json')
 
-with open('output.txt', 'w') as f:
-    f.write(sentence)
\ No newline at end of file
+    with open('output.txt', 'w') as f:
+        f.write(sentence)
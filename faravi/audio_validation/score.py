@@ -0,0 +1,83 @@
+import argparse
+import os
+from glob import glob
+from os.path import basename, join, splitext
+from typing import Dict, List, Tuple
+from sqlalchemy import update
+from faravi.audio_validation.edit_distance import error_rates
+from faravi.audio_validation.get_sentence import PUNCTUATION, load_hypotheses
+from faravi.subtitles_cleanup.db import AudioChunk, init_db, get_db_session
+from faravi.subtitles_cleanup.normalizer import TextNormalizer
+from faravi.subtitles_cleanup.utils import SingletonLogger
+
+logger = SingletonLogger().get_logger()
+
+# Rows updated per statement
+UPDATE_BATCH = 5000
+
+_STRIP_PUNCTUATION = str.maketrans({sign: ' ' for sign in PUNCTUATION})
+
+
+def words(text: str) -> List[str]:
+    """
+    Words of a transcript as compared for WER: punctuation is ignored on
+    both sides, since the ASR service and the subtitles place it differently.
+    """
+    return text.translate(_STRIP_PUNCTUATION).split()
+
+def pair_chunks(session, hypotheses: Dict[str, str]) -> List[Tuple[int, str, str]]:
+    """
+    Pairs audio_chunks rows with the hypothesis of their audio file, as
+    (id, reference text, hypothesis text).
+    """
+    rows = session.query(AudioChunk.id, AudioChunk.audio, AudioChunk.text).filter(AudioChunk.audio.isnot(None))
+    pairs = []
+    for chunk_id, audio, text in rows.yield_per(UPDATE_BATCH):
+        hypothesis = hypotheses.get(splitext(basename(audio))[0])
+        if hypothesis is not None:
+            pairs.append((chunk_id, text, hypothesis))
+    return pairs
+
+def score_chunks(session, hypotheses: Dict[str, str]) -> int:
+    """
+    Computes WER and CER of every chunk with a hypothesis and stores them in
+    the wer and cer columns. Returns the number of scored chunks.
+    Hypotheses go through the TextNormalizer the chunk texts went through,
+    so Arabic and Persian letter forms, digits and ZWNJ are not counted as
+    errors.
+    """
+    pairs = pair_chunks(session, hypotheses)
+    if not pairs:
+        return 0
+
+    normalizer = TextNormalizer()
+    references = [words(text) for _, text, _ in pairs]
+    recognized = [words(normalizer.normalize(hypothesis).text) for _, _, hypothesis in pairs]
+    wer = error_rates(references, recognized)
+    cer = error_rates([' '.join(w) for w in references], [' '.join(w) for w in recognized])
+
+    for first in range(0, len(pairs), UPDATE_BATCH):
+        session.execute(update(AudioChunk), [
+            {'id': chunk_id, 'wer': float(wer[i]), 'cer': float(cer[i])}
+            for i, (chunk_id, _, _) in enumerate(pairs[first:first + UPDATE_BATCH], first)
+        ])
+    session.commit()
+    return len(pairs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score audio chunks against ASR results and store WER/CER in data.db')
+    parser.add_argument('hypotheses', help='directory of ASR results, named after the audio chunks')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--max-wer', type=float, default=0.5, help='report chunks above this WER')
+    args = parser.parse_args()
+
+    filenames = sorted(glob(join(args.hypotheses, '*.json')))
+    logger.info(f"Loading {len(filenames)} ASR results")
+    hypotheses = load_hypotheses(filenames, args.workers)
+
+    init_db()
+    with get_db_session() as session:
+        scored = score_chunks(session, hypotheses)
+        above = session.query(AudioChunk).filter(AudioChunk.wer > args.max_wer).count()
+    logger.info(f"Scored {scored} chunks, {above} have a WER above {args.max_wer}")
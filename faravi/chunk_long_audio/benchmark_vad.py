@@ -0,0 +1,93 @@
+import argparse
+import time
+import numpy as np
+from faravi.subtitles_cleanup.audio import decode_audio
+from faravi.chunk_long_audio.chunk_long_audio_v2 import (
+    DEFAULT_CHECKPOINT, HYPER_PARAMETERS, VAD_SAMPLE_RATE, VADWorker
+)
+from faravi.chunk_long_audio.vad import CascadeVAD, EnergyVAD
+
+# Resolution of the frame level comparison
+FRAME = 0.01
+
+
+def to_mask(captions, n_frames: int) -> np.ndarray:
+    mask = np.zeros(n_frames, dtype=bool)
+    for caption in captions:
+        mask[int(caption.start / FRAME):int(np.ceil(caption.end / FRAME))] = True
+    return mask
+
+def boundary_f1(captions, reference, tolerance: float) -> float:
+    """
+    F1 of segment starts and ends that lie within tolerance seconds of a
+    reference boundary.
+    """
+    found = np.array([t for c in captions for t in (c.start, c.end)])
+    expected = np.array([t for c in reference for t in (c.start, c.end)])
+    if not len(found) or not len(expected):
+        return float(len(found) == len(expected))
+
+    distances = np.abs(found[:, None] - expected[None, :])
+    precision = np.mean(distances.min(axis=1) <= tolerance)
+    recall = np.mean(distances.min(axis=0) <= tolerance)
+    return 0.0 if precision + recall == 0 else 2 * precision * recall / (precision + recall)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare speed and agreement of the VAD backends')
+    parser.add_argument('files', nargs='+', help='audio files to run every backend on')
+    parser.add_argument('--backends', nargs='+', default=['pyannote', 'energy', 'cascade'],
+                        choices=['pyannote', 'energy', 'cascade'],
+                        help='the first one is the reference the others are compared to')
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT)
+    parser.add_argument('--device')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='seconds a boundary may be off and still agree')
+    args = parser.parse_args()
+
+    model = None
+    if {'pyannote', 'cascade'} & set(args.backends):
+        model = VADWorker(args.checkpoint, device=args.device)
+        # load the model up front, so it does not count as detection time
+        model.pipeline
+    backends = {
+        'pyannote': model,
+        'energy': EnergyVAD(HYPER_PARAMETERS),
+        'cascade': CascadeVAD(model, EnergyVAD(HYPER_PARAMETERS)) if model else None,
+    }
+
+    totals = {name: {'seconds': 0.0, 'agreement': [], 'f1': []} for name in args.backends}
+    audio_seconds = 0.0
+
+    for audio_file in args.files:
+        audio = decode_audio(audio_file, VAD_SAMPLE_RATE)
+        if audio is None:
+            continue
+        audio_seconds += audio.duration
+        n_frames = int(np.ceil(audio.duration / FRAME))
+
+        results = {}
+        for name in args.backends:
+            s = time.perf_counter()
+            results[name] = backends[name].speech(audio)
+            totals[name]['seconds'] += time.perf_counter() - s
+
+        reference = results[args.backends[0]]
+        reference_mask = to_mask(reference, n_frames)
+        for name in args.backends:
+            totals[name]['agreement'].append(np.mean(to_mask(results[name], n_frames) == reference_mask))
+            totals[name]['f1'].append(boundary_f1(results[name], reference, args.tolerance))
+
+    print(f"{audio_seconds / 3600:.2f} hours of audio, reference: {args.backends[0]}")
+    print(f"{'backend':<10} {'seconds':>9} {'x realtime':>11} {'frame agreement':>16} {'boundary F1':>12} "
+          f"{'sent to model':>14}")
+    for name, total in totals.items():
+        speed = audio_seconds / total['seconds'] if total['seconds'] else float('inf')
+        # share of the audio the precise model ran on
+        backend = backends[name]
+        if isinstance(backend, CascadeVAD):
+            model_share = backend.model_seconds / backend.total_seconds if backend.total_seconds else 0.0
+        else:
+            model_share = 1.0 if name == 'pyannote' else 0.0
+        print(f"{name:<10} {total['seconds']:>9.2f} {speed:>11.0f} "
+              f"{np.mean(total['agreement']):>16.3f} {np.mean(total['f1']):>12.3f} {model_share:>14.1%}")
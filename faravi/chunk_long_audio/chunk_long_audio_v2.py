@@ -1,32 +1,78 @@
-import multiprocessing
+import argparse
 import time
 import os
 import shutil
-import subprocess
-from huggingface_hub import HfApi, login
-from pyannote.audio.pipelines import VoiceActivityDetection
-from pyannote.audio import Model
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from queue import Queue
+from threading import Thread
+from typing import Iterator, Optional
+from huggingface_hub import HfApi
 from tenacity import retry, before_sleep_log, after_log, wait_exponential, stop_after_attempt
 from faravi.subtitles_cleanup.utils import SingletonLogger
+from faravi.subtitles_cleanup.acoustic import AcousticClassifier
+from faravi.subtitles_cleanup.segmentation import (DEFAULT_CHECKPOINT, HYPER_PARAMETERS, OverlapDetector,
+                                                   SegmentationPipeline)
+from faravi.subtitles_cleanup.hub import get_hub
 from faravi.subtitles_cleanup.chunker import Caption, AudioChunker
+from faravi.subtitles_cleanup.audio import AudioBuffer, decode_audio, stream_windows
+from faravi.chunk_long_audio.vad import VADBackend, EnergyVAD, CascadeVAD
 import logging
 
-login()
-
 logger = SingletonLogger().get_logger()
 target_repo_id = 'farsi-asr/PerSets-tarjoman-chunked'
 source_repo_id = 'PerSets/tarjoman-persian-asr'
 
-model = Model.from_pretrained(
-    "pyannote/segmentation-3.0",
-)
+# The segmentation model runs on 16 kHz mono audio
+VAD_SAMPLE_RATE = 16000
+
+# Speech segments this close across a window boundary are one segment
+STITCH_GAP = 0.05
+
+
+class VADWorker(SegmentationPipeline, VADBackend):
+    """
+    Voice activity detection with the pyannote segmentation model, loaded
+    on first use like every SegmentationPipeline.
+    """
+
+    def _pipeline_class(self):
+        from pyannote.audio.pipelines import VoiceActivityDetection
+        return VoiceActivityDetection
+
+    def speech(self, audio) -> list[Caption]:
+        return get_captions(self(audio))
+
+
+VAD_BACKENDS = ['pyannote', 'energy', 'cascade']
 
-pipeline = VoiceActivityDetection(segmentation=model)
-HYPER_PARAMETERS = {
-    "min_duration_on": 0.0,
-    "min_duration_off": 0.0
-}
-pipeline.instantiate(HYPER_PARAMETERS)
+# VAD worker and acoustic classifier of this process, shared by all files it processes
+_vad_worker: Optional[VADBackend] = None
+_classifier: Optional[AcousticClassifier] = None
+
+def init_vad_worker(checkpoint: str = DEFAULT_CHECKPOINT, device: Optional[str] = None,
+                    backend: str = 'pyannote', classify: bool = False, overlap: bool = False) -> None:
+    """
+    Sets up the VAD worker of the process, e.g. as a pool initializer.
+    The model itself is still loaded on first use. The energy backend runs
+    without the model, the cascade only runs it where energy is ambiguous.
+    With classify, chunks of music are labelled DIALOGUE and not encoded;
+    with overlap too, so are chunks the overlapped speech model flags.
+    """
+    global _vad_worker, _classifier
+    _classifier = None
+    if classify:
+        _classifier = AcousticClassifier(overlap=OverlapDetector(checkpoint, device=device).overlaps if overlap else None)
+    if backend == 'energy':
+        _vad_worker = EnergyVAD(HYPER_PARAMETERS)
+    elif backend == 'cascade':
+        _vad_worker = CascadeVAD(VADWorker(checkpoint, device=device), EnergyVAD(HYPER_PARAMETERS))
+    else:
+        _vad_worker = VADWorker(checkpoint, device=device)
+
+def get_vad_worker() -> VADBackend:
+    if _vad_worker is None:
+        init_vad_worker()
+    return _vad_worker
 
 def upload_results(tar_file):
     @retry(
@@ -47,34 +93,6 @@ def upload_results(tar_file):
 
     upload(tar_file)
 
-def get_wav_file(mp3_file):
-    logger.info(f"Converting {mp3_file} to wav")
-
-    wav_file = os.path.basename(mp3_file).replace('.MP3', '.wav')
-    cmd = ['ffmpeg', '-hwaccel', 'cuda', '-y', '-i', mp3_file, wav_file]
-
-    try:
-        result = subprocess.run(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            check=False
-        )
-
-        if result.returncode != 0:
-            logger.error(f"FFmpeg failed with return code {result.returncode}: {result.stderr}")
-            return None
-
-        return wav_file
-
-    except subprocess.SubprocessError as e:
-        logger.error(f"Subprocess error while running FFmpeg: {str(e)}")
-        return None
-    except Exception as e:
-        logger.error(f"Unexpected error while running FFmpeg: {str(e)}")
-        return None
-
 def get_captions(vad) -> list[Caption]:
     captions = []
     for segment, _, label in vad.itertracks(yield_label=True):
@@ -86,63 +104,249 @@ def get_captions(vad) -> list[Caption]:
 
     return captions
 
-def process_audio(mp3_file, json_file):
+def detect_speech(audio) -> list[Caption]:
+    """
+    Speech segments of the audio as captions, run by the VAD worker of the
+    calling process; picklable, so it can be submitted to a process pool
+    initialized with init_vad_worker.
+    """
+    return get_vad_worker().speech(audio)
+
+def stream_speech(audio_file: str, window: float = 300.0, overlap: float = 10.0) -> Iterator[list[Caption]]:
+    """
+    Runs the VAD over overlapping windows of the audio file and yields the
+    speech captions of each window as soon as it is analysed. Every window
+    owns the span up to the middle of its overlap with the next one, where
+    both windows have context; a segment reaching that boundary is held
+    back and joined with its continuation in the next window.
+    """
+    lower = 0.0
+    held = None
+
+    for offset, buffer, last in stream_windows(audio_file, VAD_SAMPLE_RATE, window, overlap):
+        boundary = offset + buffer.duration
+        if not last:
+            boundary -= overlap / 2
+
+        ready = []
+        for caption in detect_speech(buffer):
+            start = max(caption.start + offset, lower)
+            end = min(caption.end + offset, boundary)
+            if end <= start:
+                continue
+            if held is not None and start - held.end <= STITCH_GAP:
+                held.end = max(held.end, end)
+                continue
+            if held is not None:
+                ready.append(held)
+            held = Caption(start, end, '')
+
+        # only speech running into the boundary can continue in the next window
+        if held is not None and held.end < boundary - STITCH_GAP:
+            ready.append(held)
+            held = None
+        lower = boundary
+
+        if ready:
+            yield ready
+
+    if held is not None:
+        yield [held]
+
+def chunk_streaming(mp3_file: str, output_dir: str, window: float, overlap: float = 10.0) -> int:
+    """
+    Chunks the speech of mp3_file into output_dir while the VAD is still
+    analysing later windows in a background thread. Returns the number of
+    chunks. Every batch is chunked once the next one is known, so the
+    boundary between them is padded and split as in a single call.
+    """
+    batches = Queue(maxsize=2)
+
+    def produce():
+        try:
+            for batch in stream_speech(mp3_file, window, overlap):
+                batches.put(batch)
+            batches.put(None)
+        except Exception as e:
+            batches.put(e)
+
+    def next_batch():
+        while (batch := batches.get()) is not None:
+            if isinstance(batch, Exception):
+                raise batch
+            if batch:
+                return batch
+        return None
+
+    Thread(target=produce, daemon=True).start()
+
+    # fingerprints would decode the whole file for every batch
+    chunker = AudioChunker(fingerprint=False)
+    count = 0
+    previous_end = None
+    batch = next_batch()
+    while batch is not None:
+        following = next_batch()
+        next_start = min(c.start for c in following) if following else None
+        end = max(c.end for c in batch)
+        count += len(chunker.chunk(True, mp3_file, batch, output_dir, start_index=count,
+                                   previous_end=previous_end, next_start=next_start))
+        previous_end = end
+        batch = following
+    return count
+
+def chunk_file(mp3_file, json_file, work_dir: str = '.', window: Optional[float] = None,
+               overlap: float = 10.0) -> Optional[str]:
+    """
+    Chunks the speech of mp3_file into work_dir and archives the chunks with
+    the transcript JSON. Returns the archive path, or None without speech.
+    """
     s = time.time()
-    wav_file = get_wav_file(mp3_file)
 
-    if wav_file is None:
-        return
+    audio_name = os.path.basename(mp3_file).split('.')[0]
+    chunk_dir = os.path.join(work_dir, audio_name)
+    os.makedirs(chunk_dir, exist_ok=True)
 
-    audio_name = os.path.basename(wav_file).split('.')[0]
-    os.makedirs(audio_name, exist_ok=True)
+    if window:
+        logger.info(f"Running segment model on {window:.0f}s windows of {mp3_file}")
+        n_chunks = chunk_streaming(mp3_file, chunk_dir, window, overlap)
+    else:
+        # decoded once at the output rate, so chunks keep the full bandwidth,
+        # into a memory-mapped file; only the 16 kHz copy the model reads is
+        # held in memory
+        chunker = AudioChunker(classifier=_classifier)
+        samples_path = os.path.join(work_dir, f'{audio_name}.f32')
+        try:
+            logger.info(f"Decoding {mp3_file}")
+            audio = decode_audio(mp3_file, chunker.sample_rate, path=samples_path)
 
-    logger.info(f"Running segment model {wav_file}")
-    vad = pipeline(wav_file)
-    logger.info(f"Done in {time.time() - s}. Splitting audio...")
-    
-    captions = get_captions(vad)
-    if len(captions) == 0:
-        shutil.rmtree(audio_name)
-        os.remove(wav_file)
-        logger.warning(f"No speech found in {wav_file}")
-        return
-    
-    chunker = AudioChunker()
-    chunker.chunk(True, wav_file, captions, audio_name)
+            if audio is None:
+                shutil.rmtree(chunk_dir)
+                return None
+            vad_audio = audio.downsample(VAD_SAMPLE_RATE)
 
-    shutil.copy(json_file, audio_name)
+            logger.info(f"Running segment model {mp3_file}")
+            captions = detect_speech(vad_audio)
+            logger.info(f"Done in {time.time() - s}. Splitting audio...")
+
+            chunks = chunker.chunk(True, mp3_file, captions, chunk_dir, audio=audio,
+                                   analysis=vad_audio) if captions else []
+            n_chunks = sum(1 for chunk in chunks if chunk.filename)
+        finally:
+            if os.path.exists(samples_path):
+                os.remove(samples_path)
+
+    if n_chunks == 0:
+        shutil.rmtree(chunk_dir)
+        logger.warning(f"No speech found in {mp3_file}, or all of it was labelled DIALOGUE")
+        return None
+
+    shutil.copy(json_file, chunk_dir)
 
     logger.info(f"Creating archive {audio_name}")
-    tar_file = shutil.make_archive(audio_name, 'gztar', root_dir='.', base_dir=audio_name)
-    upload_results(tar_file)
+    tar_file = shutil.make_archive(chunk_dir, 'gztar', root_dir=work_dir, base_dir=audio_name)
+    shutil.rmtree(chunk_dir)
+
+    logger.info(f"Chunked {audio_name} in {time.time() - s:.1f}s")
+    return tar_file
+
+def process_audio(mp3_file, json_file, window: Optional[float] = None, overlap: float = 10.0,
+                  work_dir: str = '.'):
+    tar_file = chunk_file(mp3_file, json_file, work_dir, window, overlap)
+    if tar_file is None:
+        return
 
-    shutil.rmtree(audio_name)
+    upload_results(tar_file)
     os.remove(tar_file)
-    os.remove(wav_file)
 
-    print(f"Done in {time.time() - s}")
+def download(filename, work_dir: str, hub=None) -> tuple[str, str]:
+    """
+    Downloads the MP3 and transcript of one recording into work_dir, through
+    the blob cache of the hub if it has one.
+    """
+    local_dir = os.path.join(work_dir, 'tarjoman-persian-asr')
+    (hub or get_hub()).snapshot_download(
+        repo_id=source_repo_id,
+        repo_type='dataset',
+        allow_patterns=f'train/{filename}*',
+        local_dir=local_dir
+    )
 
-def download_and_process(filename):
-    local_dir = 'tarjoman-persian-asr'
-    try:
-        HfApi().snapshot_download(
-            repo_id=source_repo_id,
-            repo_type='dataset',
-            allow_patterns=f'train/{filename}*',
-            local_dir=local_dir
-        )
+    mp3_file = os.path.join(local_dir, f'train/{filename}.MP3')
+    json_file = os.path.join(local_dir, f'train/{filename}.json')
 
-        mp3_file = os.path.join(local_dir, f'train/{filename}.MP3')
-        json_file = os.path.join(local_dir, f'train/{filename}.json')
+    if not os.path.exists(mp3_file) or not os.path.exists(json_file):
+        raise FileNotFoundError(f'{filename} not found in {local_dir}')
 
-        if not os.path.exists(mp3_file) or not os.path.exists(json_file):
-            raise FileNotFoundError(f'{filename} not found in {local_dir}')
+    return mp3_file, json_file
 
-        process_audio(mp3_file, json_file)
+def download_and_process(filename, window: Optional[float] = None, overlap: float = 10.0,
+                         work_root: str = 'work', hub=None):
+    work_dir = os.path.join(work_root, filename)
+    try:
+        mp3_file, json_file = download(filename, work_dir, hub)
+        process_audio(mp3_file, json_file, window, overlap, work_dir)
     except Exception as e:
         logger.error(f'Error processing {filename}: {e}')
     finally:
-        shutil.rmtree(local_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def run_parallel(filenames: list[str], jobs: int = 1, prefetch: int = 1, work_root: str = 'work',
+                 window: Optional[float] = None, overlap: float = 10.0, vad_args: tuple = (),
+                 hub=None) -> None:
+    """
+    Processes the files with up to jobs + prefetch of them in flight. The
+    stages overlap: files download in threads, are chunked in a pool of
+    jobs processes that each keep one VAD worker, and upload one at a time
+    in the background. Every file has its own directory under work_root.
+    Downloads go through hub, by default get_hub().
+    """
+    hub = hub or get_hub()
+    pending = iter(enumerate(filenames))
+    # future -> (stage, index, filename)
+    in_flight: dict[Future, tuple[str, int, str]] = {}
+
+    with ThreadPoolExecutor(prefetch + 1) as downloads, \
+            ProcessPoolExecutor(jobs, initializer=init_vad_worker, initargs=vad_args) as pool, \
+            ThreadPoolExecutor(1) as uploads:
+
+        def start_next():
+            item = next(pending, None)
+            if item is None:
+                return
+            i, filename = item
+            logger.info(f'audio {i + 1:03d}/{len(filenames)}: downloading {filename}')
+            future = downloads.submit(download, filename, os.path.join(work_root, filename), hub)
+            in_flight[future] = ('download', i, filename)
+
+        def finish(filename):
+            shutil.rmtree(os.path.join(work_root, filename), ignore_errors=True)
+            start_next()
+
+        for _ in range(jobs + prefetch):
+            start_next()
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, i, filename = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f'Error in {stage} of {filename}: {e}')
+                    finish(filename)
+                    continue
+
+                if stage == 'download':
+                    mp3_file, json_file = result
+                    future = pool.submit(chunk_file, mp3_file, json_file, os.path.join(work_root, filename),
+                                         window, overlap)
+                    in_flight[future] = ('chunk', i, filename)
+                elif stage == 'chunk' and result is not None:
+                    in_flight[uploads.submit(upload_results, result)] = ('upload', i, filename)
+                else:
+                    logger.info(f'audio {i + 1:03d}/{len(filenames)}: {filename} done')
+                    finish(filename)
 
 def get_filename(filepath):
     basename = os.path.basename(filepath)
@@ -150,14 +354,47 @@ def get_filename(filepath):
     return filename
 
 if __name__ == '__main__':
-    source_files = HfApi().list_repo_files(source_repo_id, repo_type='dataset')
+    parser = argparse.ArgumentParser(description='Chunk tarjoman recordings at detected speech')
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT,
+                        help='hub id or local path of the segmentation model')
+    parser.add_argument('--device', help='torch device the model runs on, e.g. cuda')
+    parser.add_argument('--vad', default='pyannote', choices=VAD_BACKENDS,
+                        help='speech detector: the model, the energy detector, or both in cascade')
+    parser.add_argument('--window', type=float,
+                        help='run the model on windows of this many seconds and chunk while it runs')
+    parser.add_argument('--overlap', type=float, default=10.0,
+                        help='seconds consecutive windows overlap by')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of processes running VAD and slicing, one file each; without '
+                             '--window each one holds a 16 kHz copy of its file in memory, about 230 MB '
+                             'per hour, and writes a 48 kHz decode of about 700 MB per hour to --work-dir')
+    parser.add_argument('--prefetch', type=int, default=1,
+                        help='number of files downloaded ahead of the ones being chunked')
+    parser.add_argument('--work-dir', default='work', help='files are processed in sub directories of this')
+    parser.add_argument('--blob-cache-dir',
+                        help='keep downloaded recordings in this directory for later runs')
+    parser.add_argument('--blob-cache-gb', type=float, default=100.0,
+                        help='least recently used recordings are evicted beyond this size')
+    parser.add_argument('--classify', action='store_true',
+                        help='label chunks with music DIALOGUE and leave them out of the archives')
+    parser.add_argument('--overlap-model', action='store_true',
+                        help='with --classify, also leave out overlapped speech found by the segmentation model')
+    args = parser.parse_args()
+
+    if args.classify and args.window:
+        parser.error('--classify needs the whole file decoded and cannot be combined with --window')
+
+    hub = get_hub(blob_dir=args.blob_cache_dir, blob_gb=args.blob_cache_gb)
+    source_files = hub.list_repo_files(source_repo_id, repo_type='dataset')
     source_files = set([get_filename(f) for f in source_files if f.endswith('.MP3')])
     
-    dest_files = HfApi().list_repo_files(target_repo_id, repo_type='dataset')
+    # other runs may have uploaded since the listing was cached
+    hub.invalidate(target_repo_id, 'dataset')
+    dest_files = hub.list_repo_files(target_repo_id, repo_type='dataset')
     dest_files = set([get_filename(f) for f in dest_files if f.endswith('.tar.gz')])
 
-    new_files = list(source_files - dest_files)
+    new_files = sorted(source_files - dest_files)
 
-    for i, file in enumerate(new_files):
-        print(f'audio {i + 1:03d}/{len(new_files)}')
-        download_and_process(file)
+    run_parallel(new_files, args.jobs, args.prefetch, args.work_dir, args.window, args.overlap,
+                 vad_args=(args.checkpoint, args.device, args.vad, args.classify, args.overlap_model),
+                 hub=hub)
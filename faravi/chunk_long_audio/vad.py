@@ -0,0 +1,163 @@
+from abc import ABC, abstractmethod
+from typing import Optional
+import numpy as np
+from faravi.subtitles_cleanup.audio import AudioBuffer
+from faravi.subtitles_cleanup.chunker import Caption
+
+# Same keys as the pyannote pipeline parameters
+DEFAULT_HYPER_PARAMETERS = {
+    "min_duration_on": 0.0,
+    "min_duration_off": 0.0,
+    "onset": 12.0,     # dB above the noise floor that starts speech
+    "offset": 6.0,     # dB above the noise floor that keeps speech going
+}
+
+
+class VADBackend(ABC):
+    """
+    Voice activity detection on decoded 16 kHz mono audio.
+    """
+
+    @abstractmethod
+    def speech(self, audio: AudioBuffer) -> list[Caption]:
+        """
+        Returns the speech segments of the audio as captions without text.
+        """
+
+
+def mask_to_segments(mask: np.ndarray, hop: float, min_duration_on: float = 0.0,
+                     min_duration_off: float = 0.0) -> list[tuple[float, float]]:
+    """
+    Turns a per frame speech mask into (start, end) seconds. Like pyannote,
+    gaps shorter than min_duration_off are filled first, then segments
+    shorter than min_duration_on are dropped.
+    """
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1) * hop
+    ends = np.flatnonzero(edges == -1) * hop
+    if not len(starts):
+        return []
+
+    if min_duration_off > 0:
+        keep = np.concatenate([[True], starts[1:] - ends[:-1] >= min_duration_off])
+        starts = starts[keep]
+        ends = ends[np.concatenate([keep[1:], [True]])]
+
+    if min_duration_on > 0:
+        keep = ends - starts >= min_duration_on
+        starts, ends = starts[keep], ends[keep]
+
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+class EnergyVAD(VADBackend):
+    """
+    Fast CPU voice activity detection from frame energy and zero crossing
+    rate, all vectorized with NumPy. Energy is measured in dB above the
+    noise floor of the file, with hysteresis: a run of frames above offset
+    is speech if it reaches onset somewhere. Frames with a zero crossing
+    rate above max_zcr look like noise rather than voice and cannot start
+    speech on their own.
+    """
+
+    def __init__(self, hyper_parameters: Optional[dict] = None, frame: float = 0.03, hop: float = 0.01,
+                 max_zcr: float = 0.35, floor_percentile: float = 10.0):
+        self.hyper_parameters = {**DEFAULT_HYPER_PARAMETERS, **(hyper_parameters or {})}
+        self.frame = frame
+        self.hop = hop
+        self.max_zcr = max_zcr
+        self.floor_percentile = floor_percentile
+
+    def features(self, audio: AudioBuffer) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Per frame energy in dB above the noise floor and zero crossing rate.
+        """
+        frame_size = int(self.frame * audio.sample_rate)
+        hop_size = int(self.hop * audio.sample_rate)
+        if len(audio.samples) < frame_size:
+            return np.zeros(0), np.zeros(0)
+
+        frames = np.lib.stride_tricks.sliding_window_view(audio.samples, frame_size)[::hop_size]
+        energy = 10 * np.log10(np.mean(np.square(frames, dtype=np.float64), axis=1) + 1e-10)
+        relative = energy - np.percentile(energy, self.floor_percentile)
+
+        signs = np.signbit(frames)
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (frame_size - 1)
+        return relative, zcr
+
+    def mask(self, relative: np.ndarray, zcr: np.ndarray) -> np.ndarray:
+        active = relative >= self.hyper_parameters['offset']
+        onset = active & (relative >= self.hyper_parameters['onset']) & (zcr <= self.max_zcr)
+        if not active.any():
+            return active
+
+        # hysteresis: keep the runs of active frames that contain an onset
+        run_start = active & ~np.concatenate([[False], active[:-1]])
+        run_ids = np.cumsum(run_start) - 1
+        has_onset = np.add.reduceat(onset, np.flatnonzero(run_start)) > 0
+        return active & has_onset[np.maximum(run_ids, 0)]
+
+    def speech(self, audio: AudioBuffer) -> list[Caption]:
+        relative, zcr = self.features(audio)
+        segments = mask_to_segments(
+            self.mask(relative, zcr),
+            self.hop,
+            self.hyper_parameters['min_duration_on'],
+            self.hyper_parameters['min_duration_off']
+        )
+        return [Caption(start, end, '') for start, end in segments]
+
+
+class CascadeVAD(VADBackend):
+    """
+    Uses the energy detector as a cheap first pass and only runs the precise
+    backend, e.g. the pyannote model, on ambiguous regions: frames between
+    the offset threshold and margin dB above the onset threshold, padded by
+    context seconds. Frames below offset are clear silence and frames well
+    above onset clear speech, both taken from the first pass. Speech edges
+    pass through the band quickly and the first pass places them well, so
+    ambiguous runs shorter than min_ambiguous seconds are not sent.
+
+    model_seconds and total_seconds add up the audio sent to the precise
+    backend and all audio seen, to show what the cascade saves.
+    """
+
+    def __init__(self, precise: VADBackend, fast: Optional[EnergyVAD] = None, margin: float = 3.0,
+                 context: float = 0.5, min_ambiguous: float = 0.1):
+        self.precise = precise
+        self.fast = fast or EnergyVAD()
+        self.margin = margin
+        self.context = context
+        self.min_ambiguous = min_ambiguous
+        self.model_seconds = 0.0
+        self.total_seconds = 0.0
+
+    def speech(self, audio: AudioBuffer) -> list[Caption]:
+        hop = self.fast.hop
+        relative, zcr = self.fast.features(audio)
+        mask = self.fast.mask(relative, zcr)
+
+        parameters = self.fast.hyper_parameters
+        # anchored at offset, so background noise just above the floor is not ambiguous
+        band = ((relative >= parameters['offset']) &
+                (relative < parameters['onset'] + self.margin))
+        ambiguous = np.zeros_like(band)
+        for start, end in mask_to_segments(band, hop, self.min_ambiguous):
+            ambiguous[int(round(start / hop)):int(round(end / hop))] = True
+
+        # pad ambiguous regions so the model sees some context around them
+        pad = int(self.context / hop)
+        if pad and ambiguous.any():
+            ambiguous = np.convolve(ambiguous, np.ones(2 * pad + 1), mode='same') > 0
+
+        self.total_seconds += audio.duration
+        for start, end in mask_to_segments(ambiguous, hop):
+            self.model_seconds += end - start
+            first, last = int(round(start / hop)), int(round(end / hop))
+            region = AudioBuffer(audio.slice(start, end), audio.sample_rate)
+            mask[first:last] = False
+            for caption in self.precise.speech(region):
+                mask[first + int(caption.start / hop):first + int(np.ceil(caption.end / hop))] = True
+
+        segments = mask_to_segments(mask, hop, parameters['min_duration_on'], parameters['min_duration_off'])
+        return [Caption(start, end, '') for start, end in segments]
@@ -0,0 +1,123 @@
+from typing import Callable, List, Optional
+import numpy as np
+from audio import AudioBuffer
+from chunker import Caption
+from normalizer import ValidationStatus
+from utils import SingletonLogger
+
+logger = SingletonLogger().get_logger()
+
+# Statuses the classifier may replace: valid captions, and EMPTY_TEXT, which
+# is what captions from VAD alone get since they have no transcript yet
+RELABELED = {ValidationStatus.VALID, ValidationStatus.EMPTY_TEXT}
+
+
+class AcousticClassifier:
+    """
+    Flags captions whose audio is not clean single speaker speech, to be
+    labelled DIALOGUE before they are encoded. Features are computed once
+    over the decoded buffer of the whole source, in blocks of frames, and
+    all captions are scored from them at once.
+
+    Music is detected from two heuristics that must both hold: sustained
+    tones, i.e. the strongest spectral peak staying in the same frequency
+    bin for at least persistence seconds, over music_stability of the
+    caption, and a dynamic range below max_range_db, since a music bed
+    fills the pauses between words. Overlapping speakers need a detector,
+    e.g. OverlapDetector.overlaps of the segmentation module, given as
+    overlap: a callable returning the overlapped regions of a buffer as
+    captions.
+    """
+
+    def __init__(self, frame: float = 0.032, hop: float = 0.016, persistence: float = 0.2,
+                 music_stability: float = 0.3, max_range_db: float = 20.0, min_duration: float = 1.0,
+                 overlap: Optional[Callable[[AudioBuffer], List[Caption]]] = None,
+                 overlap_ratio: float = 0.2, block: int = 4096):
+        self.frame = frame
+        self.hop = hop
+        self.persistence = persistence
+        self.music_stability = music_stability
+        self.max_range_db = max_range_db
+        self.min_duration = min_duration
+        self.overlap = overlap
+        self.overlap_ratio = overlap_ratio
+        self.block = block
+
+    def features(self, audio: AudioBuffer) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Per frame energy in dB and whether the frame holds a sustained tone.
+        """
+        frame_size = int(self.frame * audio.sample_rate)
+        hop_size = int(self.hop * audio.sample_rate)
+        if len(audio.samples) < frame_size:
+            return np.zeros(0), np.zeros(0, dtype=bool)
+
+        frames = np.lib.stride_tricks.sliding_window_view(audio.samples, frame_size)[::hop_size]
+        window = np.hanning(frame_size).astype(np.float32)
+        frequencies = np.fft.rfftfreq(frame_size, 1 / audio.sample_rate)
+        band = (frequencies >= 100) & (frequencies <= 2000)
+
+        energy = np.empty(len(frames))
+        peaks = np.empty(len(frames), dtype=np.int64)
+        tonal = np.empty(len(frames), dtype=bool)
+        # in blocks, the spectrogram of a whole source does not fit in memory
+        for first in range(0, len(frames), self.block):
+            block = frames[first:first + self.block]
+            energy[first:first + len(block)] = 10 * np.log10(np.mean(np.square(block, dtype=np.float64), axis=1)
+                                                             + 1e-10)
+            spectrum = np.abs(np.fft.rfft(block * window, axis=1))[:, band]
+            peaks[first:first + len(block)] = spectrum.argmax(axis=1)
+            # an isolated peak, not broadband noise or silence
+            tonal[first:first + len(block)] = spectrum.max(axis=1) > 8 * (spectrum.mean(axis=1) + 1e-6)
+
+        # runs of frames with the same tonal peak bin
+        changes = np.concatenate([[True], (peaks[1:] != peaks[:-1]) | (tonal[1:] != tonal[:-1])])
+        run_ids = np.cumsum(changes) - 1
+        run_lengths = np.bincount(run_ids)
+        stable = tonal & (run_lengths[run_ids] * self.hop >= self.persistence)
+        return energy, stable
+
+    def classify(self, audio: AudioBuffer, captions: List[Caption]) -> np.ndarray:
+        """
+        Returns for every caption whether it holds music or overlapping speech.
+        """
+        flagged = np.zeros(len(captions), dtype=bool)
+        energy, stable = self.features(audio)
+        if not captions or len(energy) == 0:
+            return flagged
+
+        bounds = np.array([[c.start, c.end] for c in captions]) / self.hop
+        first = np.clip(np.floor(bounds[:, 0]).astype(np.int64), 0, len(energy))
+        last = np.clip(np.ceil(bounds[:, 1]).astype(np.int64), first, len(energy))
+        lengths = np.maximum(last - first, 1)
+
+        stable_sums = np.concatenate([[0], np.cumsum(stable)])
+        stability = (stable_sums[last] - stable_sums[first]) / lengths
+        ranges = np.array([
+            np.subtract(*np.percentile(energy[a:b], [90, 10])) if b > a else np.inf
+            for a, b in zip(first.tolist(), last.tolist())
+        ])
+        long_enough = (last - first) * self.hop >= self.min_duration
+        flagged |= long_enough & (stability >= self.music_stability) & (ranges <= self.max_range_db)
+
+        if self.overlap is not None:
+            overlapped = np.zeros(len(energy), dtype=bool)
+            for region in self.overlap(audio):
+                overlapped[int(region.start / self.hop):int(np.ceil(region.end / self.hop))] = True
+            overlapped_sums = np.concatenate([[0], np.cumsum(overlapped)])
+            flagged |= (overlapped_sums[last] - overlapped_sums[first]) / lengths >= self.overlap_ratio
+
+        return flagged
+
+    def label(self, audio: AudioBuffer, captions: List[Caption]) -> int:
+        """
+        Sets the status of flagged captions in RELABELED to DIALOGUE, other
+        invalidations are kept. Returns the number of relabelled captions.
+        """
+        flagged = self.classify(audio, captions)
+        count = 0
+        for caption, is_flagged in zip(captions, flagged.tolist()):
+            if is_flagged and caption.status in RELABELED:
+                caption.status = ValidationStatus.DIALOGUE
+                count += 1
+        return count
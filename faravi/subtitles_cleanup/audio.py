@@ -0,0 +1,157 @@
+import os
+import subprocess
+from dataclasses import dataclass
+from typing import Iterator, Optional
+import numpy as np
+from utils import SingletonLogger
+
+logger = SingletonLogger().get_logger()
+
+
+@dataclass
+class AudioBuffer:
+    """
+    Decoded mono audio as float32 samples in [-1, 1].
+    """
+    samples: np.ndarray
+    sample_rate: int
+
+    @property
+    def duration(self) -> float:
+        return len(self.samples) / self.sample_rate
+
+    def slice(self, start: float, end: float) -> np.ndarray:
+        """
+        Returns the samples between start and end seconds (a view, not a copy).
+        """
+        first = max(int(start * self.sample_rate), 0)
+        last = max(int(end * self.sample_rate), first)
+        return self.samples[first:last]
+
+    def envelope(self, hop: float = 0.01) -> np.ndarray:
+        """
+        Returns the energy in dB of consecutive hop second frames.
+        """
+        hop_size = max(int(hop * self.sample_rate), 1)
+        n_frames = len(self.samples) // hop_size
+        frames = self.samples[:n_frames * hop_size].reshape(n_frames, hop_size)
+        return 10 * np.log10(np.mean(np.square(frames, dtype=np.float64), axis=1) + 1e-10)
+
+    def downsample(self, sample_rate: int, taps_per_factor: int = 8) -> 'AudioBuffer':
+        """
+        Returns the audio at sample_rate, which must divide the current one.
+        A windowed sinc low pass runs first, so content above the new
+        Nyquist frequency does not fold back. The filter is applied as one
+        vectorized pass per tap over the decimated output, reading strided
+        views of the samples: besides the output only one scratch buffer of
+        its size is allocated, so a memory-mapped source is never copied.
+        """
+        factor, rest = divmod(self.sample_rate, sample_rate)
+        if rest or factor < 1:
+            raise ValueError(f"Cannot downsample {self.sample_rate} Hz to {sample_rate} Hz")
+        if factor == 1:
+            return self
+
+        half = taps_per_factor * factor // 2
+        n = np.arange(-half, half + 1)
+        cutoff = 0.45 / factor  # cycles per sample, a bit below the new Nyquist
+        taps = (2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(len(n))).astype(np.float32)
+        taps /= taps.sum()
+
+        n_in = len(self.samples)
+        n_out = n_in // factor
+        out = np.zeros(n_out, dtype=np.float32)
+        scratch = np.empty(n_out, dtype=np.float32)
+        for k, weight in enumerate(taps):
+            # output j reads sample j * factor + shift, the edges read zeros
+            shift = k - half
+            first = max(-(shift // factor), 0)
+            last = min(n_out, (n_in - shift - 1) // factor + 1)
+            if last <= first:
+                continue
+            view = self.samples[first * factor + shift:(last - 1) * factor + shift + 1:factor]
+            np.multiply(view, weight, out=scratch[:last - first])
+            out[first:last] += scratch[:last - first]
+        return AudioBuffer(out, sample_rate)
+
+
+def decode_audio(audio_file: str, sample_rate: int = 16000, path: Optional[str] = None) -> Optional[AudioBuffer]:
+    """
+    Decodes the whole audio file to a mono float32 buffer at the given sample
+    rate with a single FFmpeg run. With path set, the samples are written to
+    that file and memory-mapped instead of held in memory, e.g. for long
+    files at a high rate; the caller removes the file. Returns None on
+    failure.
+    """
+    cmd = [
+        'ffmpeg',
+        '-v', 'error',
+        '-y',
+        '-i', audio_file,
+        '-ac', '1',                    # Audio channels: 1 (mono)
+        '-ar', str(sample_rate),       # Resample to the requested rate
+        '-f', 'f32le',                 # Raw little endian float32 samples
+        path or 'pipe:1'
+    ]
+
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+
+        if result.returncode != 0:
+            logger.error(f"FFmpeg failed to decode {audio_file}: {result.stderr.decode(errors='ignore')}")
+            return None
+
+        if path is None:
+            return AudioBuffer(np.frombuffer(result.stdout, dtype=np.float32), sample_rate)
+        if os.path.getsize(path) == 0:
+            return AudioBuffer(np.zeros(0, dtype=np.float32), sample_rate)
+        return AudioBuffer(np.memmap(path, dtype=np.float32, mode='r'), sample_rate)
+
+    except Exception as e:
+        logger.error(f"Unexpected error while decoding {audio_file}: {e}")
+        return None
+
+
+def stream_windows(audio_file: str, sample_rate: int = 16000, window: float = 300.0,
+                   overlap: float = 10.0) -> Iterator[tuple[float, AudioBuffer, bool]]:
+    """
+    Decodes the audio file with a single FFmpeg run and yields it as
+    (offset, buffer, last) windows of window seconds, each one starting
+    overlap seconds before the previous one ended. Only about two windows
+    are held in memory at a time, whatever the length of the file.
+    """
+    cmd = [
+        'ffmpeg',
+        '-v', 'error',
+        '-i', audio_file,
+        '-ac', '1',
+        '-ar', str(sample_rate),
+        '-f', 'f32le',
+        'pipe:1'
+    ]
+    window_size = int(window * sample_rate)
+    overlap_size = int(overlap * sample_rate)
+    if not 0 <= overlap_size < window_size:
+        raise ValueError("overlap must be shorter than the window")
+
+    def read(n_samples):
+        return np.frombuffer(process.stdout.read(n_samples * 4), dtype=np.float32)
+
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        offset = 0
+        samples = read(window_size)
+        while len(samples):
+            # read ahead to know whether this window is the last one
+            ahead = read(window_size - overlap_size)
+            last = len(ahead) == 0
+            yield offset / sample_rate, AudioBuffer(samples, sample_rate), last
+            if last:
+                break
+            offset += len(samples) - overlap_size
+            samples = np.concatenate([samples[len(samples) - overlap_size:], ahead])
+    finally:
+        process.kill()
+        stderr = process.stderr.read()
+        if process.wait() not in (0, -9) and stderr:
+            logger.error(f"FFmpeg failed to decode {audio_file}: {stderr.decode(errors='ignore')}")
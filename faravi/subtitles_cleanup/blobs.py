@@ -0,0 +1,261 @@
+import atexit
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from threading import Lock
+from typing import Callable, Optional
+from utils import SingletonLogger
+
+logger = SingletonLogger().get_logger()
+
+
+class BlobCache:
+    """
+    Content addressed cache of downloaded repo files. Every file is stored
+    once under blobs/{sha256} and refs.json maps (repo, filename) to its
+    blob, so a file is only downloaded the first time any run needs it.
+    Source files are assumed immutable; mutable files such as data.db must
+    bypass the cache. Blobs are evicted least recently used first once the
+    cache grows beyond max_bytes, with a blob's mtime as its last use.
+
+    Several processes may share the cache: each downloads into its own
+    directory under incoming/, and refs.json is re-read and merged under a
+    file lock before every atomic rewrite, so no process loses the refs of
+    another.
+    """
+
+    def __init__(self, root: str, max_bytes: int = 100 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._blobs_dir = os.path.join(root, 'blobs')
+        self._refs_path = os.path.join(root, 'refs.json')
+        self._lock_path = os.path.join(root, 'refs.lock')
+        incoming_dir = os.path.join(root, 'incoming')
+        self._incoming_dir = os.path.join(incoming_dir, f'{os.getpid()}-{uuid.uuid4().hex[:8]}')
+
+        os.makedirs(self._blobs_dir, exist_ok=True)
+        os.makedirs(self._incoming_dir)
+        atexit.register(shutil.rmtree, self._incoming_dir, True)
+        _remove_stale_incoming(incoming_dir)
+        with self._locked():
+            self._refs: dict[str, str] = self._load_refs()
+
+    @staticmethod
+    def _ref(repo_id: str, filename: str, repo_type: Optional[str]) -> str:
+        return f'{repo_type}:{repo_id}/{filename}'
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self._blobs_dir, digest)
+
+    @contextmanager
+    def _locked(self):
+        """
+        Holds the lock of this process's threads and the file lock shared
+        with other processes.
+        """
+        with self._lock, open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_refs(self) -> dict[str, str]:
+        if not os.path.isfile(self._refs_path):
+            return {}
+        with open(self._refs_path, 'r') as f:
+            refs = json.load(f)
+        # drop refs whose blob was removed behind our back
+        return {ref: digest for ref, digest in refs.items() if os.path.isfile(self._blob_path(digest))}
+
+    def _save_refs(self) -> None:
+        # only called under the file lock, the temp file is still per process
+        tmp_path = f'{self._refs_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._refs, f)
+        os.replace(tmp_path, self._refs_path)
+
+    def lookup(self, repo_id: str, filename: str, repo_type: Optional[str] = None) -> Optional[str]:
+        """
+        Returns the blob path of a cached file and marks it as used, or None.
+        """
+        ref = self._ref(repo_id, filename, repo_type)
+        with self._lock:
+            digest = self._refs.get(ref)
+        if digest is None:
+            # another process may have cached it since the refs were read
+            with self._locked():
+                self._refs = self._load_refs()
+                digest = self._refs.get(ref)
+            if digest is None:
+                return None
+        path = self._blob_path(digest)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def fetch(self, repo_id: str, filename: str, repo_type: Optional[str], local_dir: str,
+              download: Callable[[str], str]) -> str:
+        """
+        Places the file at local_dir/filename, from the cache if possible.
+        On a miss, download(tmp_dir) must save the file under tmp_dir and
+        return its path; it is then added to the cache.
+        """
+        blob = self.lookup(repo_id, filename, repo_type)
+        if blob is None:
+            blob = self._add(repo_id, filename, repo_type, download)
+        else:
+            logger.info(f"Using cached {filename} of {repo_id}")
+
+        target = os.path.join(local_dir, filename)
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            # hard links make placing and later deleting the copy free
+            os.link(blob, target)
+        except OSError:
+            shutil.copyfile(blob, target)
+        return target
+
+    def tee(self, repo_id: str, filename: str, repo_type: Optional[str], stream) -> 'TeeStream':
+        """
+        Wraps a download stream so that everything read from it is also
+        written to the incoming directory. The file is added to the cache
+        once the stream is closed after being read without errors.
+        """
+        tmp_dir = os.path.join(self._incoming_dir, uuid.uuid4().hex)
+        os.makedirs(tmp_dir)
+        path = os.path.join(tmp_dir, os.path.basename(filename))
+
+        def on_close(digest: Optional[str]) -> None:
+            try:
+                if digest is not None:
+                    self._store(repo_id, filename, repo_type, path, digest)
+                    logger.info(f"Cached streamed {filename} of {repo_id}")
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return TeeStream(stream, path, on_close)
+
+    def _add(self, repo_id: str, filename: str, repo_type: Optional[str],
+             download: Callable[[str], str]) -> str:
+        tmp_dir = os.path.join(self._incoming_dir, uuid.uuid4().hex)
+        os.makedirs(tmp_dir)
+        try:
+            path = download(tmp_dir)
+            return self._store(repo_id, filename, repo_type, path, _sha256(path))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _store(self, repo_id: str, filename: str, repo_type: Optional[str], path: str, digest: str) -> str:
+        """
+        Moves a complete file of the incoming directory into the blobs and
+        refs it. Returns the blob path.
+        """
+        blob = self._blob_path(digest)
+        with self._locked():
+            if os.path.exists(blob):
+                os.utime(blob)
+            else:
+                os.replace(path, blob)
+            # merge with what other processes added meanwhile
+            self._refs = self._load_refs()
+            self._refs[self._ref(repo_id, filename, repo_type)] = digest
+            self._evict(keep=digest)
+            self._save_refs()
+        return blob
+
+    def _evict(self, keep: str) -> None:
+        blobs = []
+        for entry in os.scandir(self._blobs_dir):
+            stat = entry.stat()
+            blobs.append((stat.st_mtime, stat.st_size, entry.name))
+        total = sum(size for _, size, _ in blobs)
+
+        evicted = set()
+        for _, size, digest in sorted(blobs):
+            if total <= self.max_bytes:
+                break
+            if digest == keep:
+                continue
+            os.remove(self._blob_path(digest))
+            evicted.add(digest)
+            total -= size
+
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} blobs from {self.root}")
+            self._refs = {ref: digest for ref, digest in self._refs.items() if digest not in evicted}
+
+
+class TeeStream:
+    """
+    Binary stream reading from another one while copying and hashing what
+    it reads into a file. Closed without an error in its with block, the
+    rest of the source is read too, e.g. the padding after the end of a tar
+    archive, and on_close gets the digest of the whole file; closed on an
+    error, on_close gets None since the copy may be incomplete.
+    """
+
+    def __init__(self, stream, path: str, on_close: Callable[[Optional[str]], None]):
+        self._stream = stream
+        self._file = open(path, 'wb')
+        self._sha = hashlib.sha256()
+        self._on_close = on_close
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        if data:
+            self._file.write(data)
+            self._sha.update(data)
+        return data
+
+    def close(self, complete: bool = True) -> None:
+        if self._file.closed:
+            return
+        digest = None
+        try:
+            if complete:
+                while self.read(1 << 20):
+                    pass
+                digest = self._sha.hexdigest()
+        finally:
+            self._stream.close()
+            self._file.close()
+            self._on_close(digest)
+
+    def __enter__(self) -> 'TeeStream':
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        self.close(complete=exc_type is None)
+
+
+def _remove_stale_incoming(incoming_dir: str) -> None:
+    """
+    Removes download directories of processes that no longer run; their
+    downloads were interrupted and are never complete blobs.
+    """
+    for entry in os.scandir(incoming_dir):
+        try:
+            pid = int(entry.name.split('-', 1)[0])
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            shutil.rmtree(entry.path, ignore_errors=True)
+        except (ValueError, PermissionError):
+            # not ours to judge: another user's process, or an unknown name
+            continue
+
+def _sha256(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
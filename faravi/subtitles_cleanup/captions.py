@@ -0,0 +1,118 @@
+import re
+from typing import Iterator, List, Optional
+from chunker import Caption
+from utils import SingletonLogger
+
+logger = SingletonLogger().get_logger()
+
+# Cue timing line of both formats: hours are optional in VTT, milliseconds
+# follow a dot in VTT and a comma in SRT, VTT cue settings may follow
+TIMING = re.compile(
+    r'\s*(?:(\d+):)?(\d+):(\d+)[.,](\d+)\s*-->\s*(?:(\d+):)?(\d+):(\d+)[.,](\d+)'
+)
+CUE_TAGS = re.compile(r'<.*?>')
+
+
+def sniff_format(first_line: str) -> str:
+    """
+    Returns 'vtt' or 'srt' from the first non empty line of a subtitle file.
+    """
+    return 'vtt' if first_line.strip().startswith('WEBVTT') else 'srt'
+
+def _seconds(hours: Optional[str], minutes: str, seconds: str, fraction: str) -> float:
+    return (int(hours) * 3600 if hours else 0) + int(minutes) * 60 + int(seconds) + int(fraction) / 10 ** len(fraction)
+
+def _parse_cue(lines: List[str]) -> Optional[Caption]:
+    """
+    Parses one block of lines into a caption. Returns None for blocks
+    without timing, e.g. the VTT header, NOTE and STYLE blocks. Raises
+    ValueError if the timing is malformed.
+    """
+    for i, line in enumerate(lines):
+        if '-->' in line:
+            break
+    else:
+        return None
+
+    match = TIMING.match(line)
+    if match is None:
+        raise ValueError(f"malformed timing {line.strip()!r}")
+
+    groups = match.groups()
+    start = _seconds(*groups[:4])
+    end = _seconds(*groups[4:])
+    if end < start:
+        raise ValueError(f"cue ends before it starts: {line.strip()!r}")
+
+    text = '\n'.join(lines[i + 1:])
+    if '<' in text:
+        text = CUE_TAGS.sub('', text)
+    return Caption(start=start, end=end, text=text.strip())
+
+def iter_captions(sub_path: str) -> Iterator[Caption]:
+    """
+    Lazily parses a VTT or SRT file, sniffed from its content, into captions
+    with times in float seconds. A malformed cue is logged and skipped, the
+    rest of the file is still read.
+    """
+    file_format = None
+    block: List[str] = []
+    block_line = 0
+    skipped = 0
+
+    def flush():
+        nonlocal skipped
+        try:
+            return _parse_cue(block)
+        except ValueError as e:
+            logger.warning(f"Skipping cue at line {block_line} of {sub_path} ({file_format}): {e}")
+            skipped += 1
+            return None
+
+    with open(sub_path, 'r', encoding='utf-8-sig', errors='replace') as f:
+        for number, line in enumerate(f, 1):
+            line = line.rstrip('\r\n')
+
+            if not line.strip():
+                if block:
+                    caption = flush()
+                    if caption is not None:
+                        yield caption
+                    block = []
+                continue
+
+            if file_format is None:
+                file_format = sniff_format(line)
+
+            # a timing line inside a cue starts the next one, when the blank
+            # line between them is missing
+            if '-->' in line and any('-->' in previous for previous in block):
+                index = [block.pop()] if block[-1].strip().isdigit() else []
+                caption = flush()
+                if caption is not None:
+                    yield caption
+                block = index
+                block_line = number - len(index)
+
+            if not block:
+                block_line = number
+            block.append(line)
+
+        if block:
+            caption = flush()
+            if caption is not None:
+                yield caption
+
+    if skipped:
+        logger.warning(f"Skipped {skipped} malformed cues in {sub_path}")
+
+def read_subtitles(sub_path: str) -> List[Caption]:
+    """
+    Reads all captions of a VTT or SRT file, or returns [] if it cannot be
+    read at all.
+    """
+    try:
+        return list(iter_captions(sub_path))
+    except OSError as e:
+        logger.error(f"Error reading subtitles from {sub_path}: {e}")
+        return []
@@ -0,0 +1,62 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Any, Callable, Iterator, Optional
+from chunker import AudioChunker
+
+# Chunker of a worker process, created once by the pool initializer
+_worker_chunker: Optional[AudioChunker] = None
+
+def _init_worker(options: dict) -> None:
+    global _worker_chunker
+    _worker_chunker = AudioChunker(**options)
+
+def worker_chunker() -> AudioChunker:
+    """
+    The chunker of the current worker process, for functions submitted to
+    a ChunkingPool.
+    """
+    return _worker_chunker
+
+
+class ChunkingPool:
+    """
+    Process pool whose workers each build one AudioChunker from the given
+    options. Results are consumed in submission order by the parent, the
+    single writer of shards and rows, and at most 2 * workers media are in
+    flight so encoded samples do not pile up in memory.
+    """
+
+    def __init__(self, workers: int, **options):
+        self.workers = workers
+        self._executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(options,))
+        self._in_flight: deque[tuple[Any, Future]] = deque()
+
+    def submit(self, item: Any, fn: Callable, *args) -> None:
+        self._in_flight.append((item, self._executor.submit(fn, *args)))
+
+    def completed(self, limit: Optional[int] = None) -> Iterator[tuple[Any, Future]]:
+        """
+        Yields (item, future) in submission order until at most limit are
+        left in flight, 2 * workers by default and 0 to drain the pool.
+        """
+        limit = 2 * self.workers if limit is None else limit
+        while len(self._in_flight) > limit:
+            yield self._in_flight.popleft()
+
+    def discard(self) -> None:
+        """
+        Drops the media still in flight, e.g. after the unit failed.
+        """
+        for _, future in self._in_flight:
+            future.cancel()
+        self._in_flight.clear()
+
+    def shutdown(self) -> None:
+        self.discard()
+        self._executor.shutdown()
+
+    def __enter__(self) -> 'ChunkingPool':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.shutdown()
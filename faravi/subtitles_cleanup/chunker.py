@@ -1,12 +1,27 @@
 import os
+import json
+import time
 from dataclasses import dataclass
-from typing import Optional, List
+from typing import Collection, Optional, List, Union
+import numpy as np
 from normalizer import ValidationStatus, TextNormalizer
 import subprocess
+from audio import AudioBuffer, decode_audio
+from hashing import exact_audio_hash
+from shards import ShardWriter
 from utils import SingletonLogger
 
 logger = SingletonLogger().get_logger()
 
+
+class ChunkingError(Exception):
+    """
+    Raised when a media could not be chunked, e.g. FFmpeg failed, as opposed
+    to a media that simply has no captions. The media should be retried,
+    not recorded as processed.
+    """
+
+
 @dataclass
 class Caption:
     start: float
@@ -14,6 +29,7 @@ class Caption:
     text: str
     status: Optional[ValidationStatus] = None
     filename: Optional[str] = None
+    audio_hash: Optional[str] = None
 
     def copy(self) -> 'Caption':
         return Caption(**self.__dict__)
@@ -23,8 +39,40 @@ class Caption:
 
 
 class AudioChunker:
-    def __init__(self):
+    FINGERPRINT_SAMPLE_RATE = 8000
+    # Resolution of the energy envelope boundaries are refined on
+    ENVELOPE_HOP = 0.01  # seconds
+    # Frames this close to the quietest one in reach count as silence
+    SILENCE_TOLERANCE = 3.0  # dB
+    # Refined chunks keep at least this fraction of their unrefined length
+    MIN_REFINED_FRACTION = 0.5
+    # codec name -> (FFmpeg encoder, container format, file extension)
+    CODECS = {
+        'mp3': ('mp3', 'mp3', 'mp3'),
+        'opus': ('libopus', 'ogg', 'opus'),
+        'flac': ('flac', 'flac', 'flac'),
+        'aac': ('aac', 'adts', 'aac'),
+    }
+
+    def __init__(self, fingerprint: bool = True, sample_rate: int = 48000, bitrate: str = '64k',
+                 codec: str = 'mp3', refine_window: float = 0.0, classifier=None):
+        """
+        With refine_window above 0, every chunk start and end is moved by up
+        to that many seconds to the nearest quiet point of the audio. With a
+        classifier, e.g. an AcousticClassifier, the chunks it flags are
+        labelled DIALOGUE and not encoded.
+        """
+        if codec not in self.CODECS:
+            raise ValueError(f"Unsupported codec: {codec}")
+
         self.normalizer = TextNormalizer()
+        self.fingerprint = fingerprint
+        self.sample_rate = sample_rate
+        self.bitrate = bitrate
+        self.codec = codec
+        self.refine_window = refine_window
+        self.classifier = classifier
+        self.encoder, self.format, self.extension = self.CODECS[codec]
 
     def _filter_captions(self, captions: List[Caption]) -> tuple[List[Caption], List[Caption]]:
         filtered_captions = []
@@ -69,10 +117,14 @@ class AudioChunker:
         merged_captions.append(current_caption)
         return merged_captions
 
-    def _adjust_start_end(self, captions: List[Caption], duration: float) -> List[Caption]:
+    def _adjust_start_end(self, captions: List[Caption], duration: float, previous_end: Optional[float] = None,
+                          next_start: Optional[float] = None) -> List[Caption]:
         """
         Adjusts the start and end times of captions to ensure they do not
-        overlap and fit within the given audio length.
+        overlap and fit within the given audio length. previous_end and
+        next_start are the unadjusted bounds of the captions just before and
+        after these ones, for files chunked in several calls: the shared
+        boundary is resolved the same way on both sides.
         """
         RANGE = 0.25  # seconds
         adjusted = []
@@ -80,15 +132,26 @@ class AudioChunker:
             adjusted.append(Caption(caption.start - RANGE,
                             caption.end + RANGE, caption.text, caption.status))
 
+        def split(curr_end, next_start):
+            return round((curr_end + next_start) / 2.0, 3) if curr_end > next_start else None
+
         # Resolve overlaps between consecutive captions
         for i in range(len(adjusted) - 1):
-            curr_end = adjusted[i].end
-            next_start = adjusted[i + 1].start
-            if curr_end > next_start:
-                avg = round((curr_end + next_start) / 2.0, 3)
+            avg = split(adjusted[i].end, adjusted[i + 1].start)
+            if avg is not None:
                 adjusted[i].end = avg
                 adjusted[i + 1].start = avg
 
+        # and with the captions of the neighbouring calls
+        if previous_end is not None:
+            avg = split(previous_end + RANGE, adjusted[0].start)
+            if avg is not None:
+                adjusted[0].start = avg
+        if next_start is not None:
+            avg = split(adjusted[-1].end, next_start - RANGE)
+            if avg is not None:
+                adjusted[-1].end = avg
+
         # Ensure the first caption starts at 0 or later
         if adjusted[0].start < 0:
             adjusted[0].start = 0
@@ -99,6 +162,67 @@ class AudioChunker:
 
         return adjusted
 
+    def _refine_boundaries(self, captions: List[Caption], audio: AudioBuffer) -> List[Caption]:
+        """
+        Snaps the start and end of every caption to the nearest quiet frame
+        within refine_window seconds, using an energy envelope of the whole
+        file computed once. A frame is quiet if it is within
+        SILENCE_TOLERANCE dB of the quietest frame in reach. Both boundaries
+        of a caption are snapped or kept together: snapping is rejected if
+        it would overlap the previous chunk, reach past the unrefined start
+        of the next one, or keep less than MIN_REFINED_FRACTION of the
+        length. Captions keep their order and never overlap afterwards.
+        """
+        hop = self.ENVELOPE_HOP
+        envelope = audio.envelope(hop)
+        if not captions or len(envelope) == 0:
+            return captions
+
+        reach = int(self.refine_window / hop)
+        offsets = np.arange(-reach, reach + 1)
+        boundaries = np.array([[c.start, c.end] for c in captions]).ravel()
+
+        # candidate frames around every boundary, all boundaries at once
+        centers = np.round(boundaries / hop).astype(np.int64)
+        candidates = np.clip(centers[:, None] + offsets, 0, len(envelope) - 1)
+        energy = envelope[candidates]
+        quiet = energy <= energy.min(axis=1, keepdims=True) + self.SILENCE_TOLERANCE
+        nearest = np.where(quiet, np.abs(offsets), reach + 1).argmin(axis=1)
+        snapped = np.clip(candidates[np.arange(len(centers)), nearest] * hop, 0, audio.duration)
+
+        # the unrefined start of the next caption bounds every end, so a
+        # caption keeping its padded boundaries never overlaps the previous one
+        next_starts = [c.start for c in captions[1:]] + [audio.duration]
+        previous_end = 0.0
+        for caption, start, end, next_start in zip(captions, snapped[0::2].tolist(), snapped[1::2].tolist(),
+                                                   next_starts):
+            min_length = max(hop, self.MIN_REFINED_FRACTION * (caption.end - caption.start))
+            if previous_end <= start and end <= next_start and end - start >= min_length:
+                caption.start, caption.end = round(start, 3), round(end, 3)
+            previous_end = caption.end
+        return captions
+
+    def _ffmpeg_cmd(self, audio_file: str, start: float, end: float, output: str) -> List[str]:
+        """
+        Returns the FFmpeg command slicing audio_file from start to end into
+        the configured codec, by default MP3 with 48.0 kHz sample rate and
+        64.0 kb/s constant bit rate.
+        """
+        return [
+            'ffmpeg',
+            '-hwaccel', 'cuda',            # Use hardware acceleration (if available)
+            '-y',                          # Overwrite output file if it exists
+            '-ss', str(start),             # Start time in seconds (input option)
+            '-i', audio_file,              # Input file
+            '-t', str(end - start),        # Duration in seconds (output option)
+            '-c:a', self.encoder,          # Audio codec (output option)
+            '-ar', str(self.sample_rate),  # Sample rate (output option)
+            '-b:a', self.bitrate,          # Bit rate (output option)
+            '-ac', '1',                    # Audio channels: 1 (mono) (output option)
+            '-map', '0:a',                 # Map only audio streams from input
+            output
+        ]
+
     def _slice_audio(self, audio_file: str, start: float, end: float, output_file: str) -> Optional[str]:
         """
         Slices the audio file from start to end and converts it to MP3 format with
@@ -114,21 +238,7 @@ class AudioChunker:
         Returns:
             Optional[str]: Path to the output file if successful, None if failed.
         """
-        # FFmpeg command
-        cmd = [
-            'ffmpeg',
-            '-hwaccel', 'cuda',            # Use hardware acceleration (if available)
-            '-y',                          # Overwrite output file if it exists
-            '-ss', str(start),             # Start time in seconds (input option)
-            '-i', audio_file,              # Input file
-            '-t', str(end - start),        # Duration in seconds (output option)
-            '-c:a', 'mp3',                 # Audio codec: MP3 (output option)
-            '-ar', '48000',                # Sample rate: 48.0 kHz (output option)
-            '-b:a', '64k',                 # Bit rate: 64.0 kb/s (output option)
-            '-ac', '1',                    # Audio channels: 1 (mono) (output option)
-            '-map', '0:a',                 # Map only audio streams from input
-            output_file
-        ]
+        cmd = self._ffmpeg_cmd(audio_file, start, end, output_file)
 
         try:
             # Run FFmpeg and capture output
@@ -158,7 +268,72 @@ class AudioChunker:
         except Exception as e:
             logger.error(f"Unexpected error: {str(e)}")
             return None
-    
+
+    def _encode_audio(self, audio_file: str, start: float, end: float) -> Optional[bytes]:
+        """
+        Same as _slice_audio, but returns the encoded bytes from FFmpeg's
+        stdout instead of writing a file. Returns None on failure.
+        """
+        cmd = self._ffmpeg_cmd(audio_file, start, end, 'pipe:1')
+        cmd[-1:-1] = ['-f', self.format]
+
+        try:
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+
+            if result.returncode != 0:
+                logger.error(f"FFmpeg failed with return code {result.returncode}: "
+                             f"{result.stderr.decode(errors='ignore')}")
+                return None
+
+            if not result.stdout:
+                logger.error(f"FFmpeg produced no output for {audio_file} [{start}, {end}]")
+                return None
+
+            return result.stdout
+
+        except Exception as e:
+            logger.error(f"Unexpected error: {str(e)}")
+            return None
+
+    def _encode_samples(self, samples, sample_rate: int, output: str = 'pipe:1') -> Optional[Union[bytes, str]]:
+        """
+        Encodes already decoded mono float32 samples, piped to FFmpeg's stdin,
+        into the configured codec. Returns the encoded bytes for pipe:1,
+        otherwise the output file path, or None on failure.
+        """
+        cmd = [
+            'ffmpeg',
+            '-y',
+            '-f', 'f32le',                 # Raw little endian float32 input
+            '-ar', str(sample_rate),
+            '-ac', '1',
+            '-i', 'pipe:0',
+            '-c:a', self.encoder,
+            '-ar', str(self.sample_rate),
+            '-b:a', self.bitrate,
+            '-ac', '1',
+        ]
+        if output == 'pipe:1':
+            cmd += ['-f', self.format]
+        cmd.append(output)
+
+        try:
+            result = subprocess.run(cmd, input=samples.tobytes(), stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, check=False)
+
+            if result.returncode != 0:
+                logger.error(f"FFmpeg failed with return code {result.returncode}: "
+                             f"{result.stderr.decode(errors='ignore')}")
+                return None
+
+            if output == 'pipe:1':
+                return result.stdout or None
+            return output if os.path.isfile(output) else None
+
+        except Exception as e:
+            logger.error(f"Unexpected error: {str(e)}")
+            return None
+
     def _get_audio_duration(self, audio_file: str) -> float:
         """
         Returns the duration of the audio file in seconds.
@@ -176,11 +351,33 @@ class AudioChunker:
         result = subprocess.run(cmd, capture_output=True, text=True)
         return float(result.stdout.strip())
 
-    def chunk(self, merge: bool, audio_file: str, captions: List[Caption], output_dir: str) -> tuple[List[Caption], List[Caption]]:
+    def chunk(self, merge: bool, audio_file: str, captions: List[Caption], output_dir: Optional[str] = None,
+              writer: Optional[ShardWriter] = None,
+              encode_statuses: Optional[Collection[ValidationStatus]] = None,
+              audio: Optional[AudioBuffer] = None, start_index: int = 0,
+              analysis: Optional[AudioBuffer] = None, previous_end: Optional[float] = None,
+              next_start: Optional[float] = None) -> tuple[List[Caption], List[Caption]]:
         """
         Slices the audio file according to the given captions and writes the
-        audio chunks to the output directory. If merge is True, captions will be merged.
+        audio chunks to the output directory, or streams them together with
+        their transcript JSON into the given shard writer. If merge is True,
+        captions will be merged. If encode_statuses is given, only captions
+        with these statuses get audio, the others are returned without a
+        filename. If the file was already decoded into audio, chunks are
+        encoded from that buffer and the file is not read again. Chunks are
+        numbered from start_index + 1, for files chunked in several calls;
+        previous_end and next_start then give the end of the last caption of
+        the previous call and the start of the first one of the next, so
+        chunks never overlap across calls. With refine_window set or a classifier, boundaries are refined and
+        chunks classified on analysis, a low rate copy of audio the caller
+        already has, else on audio, else on a low rate decode that is then
+        reused for fingerprints. Raises ChunkingError if the audio could not
+        be chunked, so a failure is never mistaken for a media without
+        chunks.
         """
+        if not captions:
+            return []
+
         try:
             # Ensure captions are sorted by start time
             captions.sort(key=lambda c: c.start)
@@ -190,26 +387,117 @@ class AudioChunker:
             if merge:
                 captions = self._merge(captions)
 
+            analysis = analysis or audio
+            if analysis is None and (self.refine_window > 0 or self.classifier is not None):
+                analysis = decode_audio(audio_file, self.FINGERPRINT_SAMPLE_RATE)
+
             # Convert audio length to seconds for consistency
             captions = self._adjust_start_end(
                 captions,
-                self._get_audio_duration(audio_file)
+                analysis.duration if analysis is not None else self._get_audio_duration(audio_file),
+                previous_end,
+                next_start
             )
 
-            for i, cap in enumerate(captions):
-                filename = f'{os.path.basename(audio_file).split(".")[0]}_{i+1:04d}.mp3'
+            if analysis is not None and self.refine_window > 0:
+                started = time.perf_counter()
+                captions = self._refine_boundaries(captions, analysis)
+                logger.debug(f"Refined {len(captions)} chunk boundaries of {audio_file} "
+                             f"in {time.perf_counter() - started:.3f} s")
+
+            if analysis is not None and self.classifier is not None:
+                labelled = self.classifier.label(analysis, captions)
+                if labelled:
+                    logger.info(f"Labelled {labelled} of {len(captions)} chunks of {audio_file} as DIALOGUE")
+                # flagged chunks are not worth their encode time, unless asked for
+                if encode_statuses is None:
+                    encode_statuses = set(ValidationStatus) - {ValidationStatus.DIALOGUE}
+
+            return self.slice(audio_file, captions, output_dir, writer, encode_statuses, audio, start_index,
+                              analysis)
+        
+        except ChunkingError:
+            raise
+        except Exception as e:
+            raise ChunkingError(f'Failed to chunk audio "{audio_file}": {e}') from e
 
-                self._slice_audio(
+    def slice(self, audio_file: str, captions: List[Caption], output_dir: Optional[str] = None,
+              writer: Optional[ShardWriter] = None,
+              encode_statuses: Optional[Collection[ValidationStatus]] = None,
+              audio: Optional[AudioBuffer] = None, start_index: int = 0,
+              analysis: Optional[AudioBuffer] = None) -> List[Caption]:
+        """
+        Slices the audio file at captions that are already normalized and
+        adjusted, e.g. read back from the database. Captions that have a
+        filename keep its stem as their key, the others are numbered in
+        order. Returns the captions, with filename set on the written ones.
+        """
+        # Decode once at a low rate to fingerprint every chunk from memory,
+        # unless the caller already decoded the whole file
+        buffer = analysis or audio
+        if buffer is None and self.fingerprint:
+            buffer = decode_audio(audio_file, self.FINGERPRINT_SAMPLE_RATE)
+
+        encode_seconds = encoded_audio = skipped_audio = 0.0
+        skipped = 0
+
+        for i, cap in enumerate(captions):
+            # unused for training, so recorded without audio
+            if encode_statuses is not None and cap.status not in encode_statuses:
+                cap.filename = None
+                skipped += 1
+                skipped_audio += cap.end - cap.start
+                continue
+
+            if cap.filename:
+                key = os.path.splitext(cap.filename)[0]
+            else:
+                key = f'{os.path.basename(audio_file).split(".")[0]}_{start_index+i+1:04d}'
+            filename = f'{key}.{self.extension}'
+
+            started = time.perf_counter()
+            if writer is not None:
+                if audio is not None:
+                    data = self._encode_samples(audio.slice(cap.start, cap.end), audio.sample_rate)
+                else:
+                    data = self._encode_audio(audio_file, cap.start, cap.end)
+                if data is None:
+                    raise ChunkingError(f"Failed to encode {key} [{cap.start}, {cap.end}]")
+                writer.write(key, {
+                    self.extension: data,
+                    'json': json.dumps({
+                        'text': cap.text,
+                        'start': cap.start,
+                        'end': cap.end,
+                        'status': cap.status.name
+                    }, ensure_ascii=False).encode('utf-8')
+                })
+            elif audio is not None:
+                if self._encode_samples(
+                    audio.slice(cap.start, cap.end),
+                    audio.sample_rate,
+                    os.path.join(output_dir, filename)
+                ) is None:
+                    raise ChunkingError(f"Failed to encode {filename} [{cap.start}, {cap.end}]")
+            else:
+                if self._slice_audio(
                     audio_file,
                     cap.start,
                     cap.end,
                     os.path.join(output_dir, filename)
-                )
-
-                cap.filename = filename
-
-            return captions
-        
-        except Exception as e:
-            logger.error(f'Failed to chunk audio "{audio_file}", Error message: {e}')
-            return []
+                ) is None:
+                    raise ChunkingError(f"Failed to encode {filename} [{cap.start}, {cap.end}]")
+            encode_seconds += time.perf_counter() - started
+            encoded_audio += cap.end - cap.start
+
+            cap.filename = filename
+            if buffer is not None and self.fingerprint:
+                cap.audio_hash = exact_audio_hash(buffer.slice(cap.start, cap.end), buffer.sample_rate)
+
+        if skipped:
+            # estimated from the encode speed of the chunks that were encoded
+            saved = encode_seconds / encoded_audio * skipped_audio if encoded_audio else 0.0
+            logger.info(f"Skipped encoding {skipped} of {len(captions)} chunks ({skipped_audio:.1f} s of audio) "
+                        f"of {audio_file}, saving about {saved:.1f} s of encoding")
+
+        return captions
@@ -1,11 +1,15 @@
-from sqlalchemy import create_engine, Column, Integer, Float, String, Enum as SQLEnum
+from sqlalchemy import create_engine, inspect, func, text, Column, Integer, Float, String, Enum as SQLEnum
 from sqlalchemy.sql import exists
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from contextlib import contextmanager
+from typing import Callable, Optional
 from chunker import Caption
 from normalizer import ValidationStatus
+from hashing import text_hash
 import logging
+import time
 
 # Set up logging
 logging.basicConfig(level=logging.WARNING)
@@ -30,11 +34,128 @@ class AudioChunk(Base):
     source_id = Column(String, nullable=False)
     start = Column(Float, nullable=False)
     end = Column(Float, nullable=False)
+    duration = Column(Float, nullable=True, index=True)
     invalidation = Column(SQLEnum(ValidationStatus), nullable=False)
+    audio_hash = Column(String, nullable=True, index=True)
+    text_hash = Column(String, nullable=True, index=True)
+    wer = Column(Float, nullable=True, index=True)
+    cer = Column(Float, nullable=True, index=True)
+
+# Columns added to audio_chunks after databases were already uploaded, with their DDL type
+_ADDED_COLUMNS = {
+    'duration': 'FLOAT',
+    'audio_hash': 'VARCHAR',
+    'text_hash': 'VARCHAR',
+    'wer': 'FLOAT',
+    'cer': 'FLOAT',
+}
+
+# External content FTS5 index over audio_chunks.text, kept in sync by triggers
+_FTS_DDL = [
+    """CREATE VIRTUAL TABLE audio_chunks_fts USING fts5(
+        text, content='audio_chunks', content_rowid='id'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS audio_chunks_fts_insert AFTER INSERT ON audio_chunks BEGIN
+        INSERT INTO audio_chunks_fts(rowid, text) VALUES (new.id, new.text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS audio_chunks_fts_delete AFTER DELETE ON audio_chunks BEGIN
+        INSERT INTO audio_chunks_fts(audio_chunks_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS audio_chunks_fts_update AFTER UPDATE OF text ON audio_chunks BEGIN
+        INSERT INTO audio_chunks_fts(audio_chunks_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO audio_chunks_fts(rowid, text) VALUES (new.id, new.text);
+    END""",
+]
+
+# ORM Model for the per source summary, kept up to date by create_chunk(s)
+class ChunkStats(Base):
+    __tablename__ = 'chunk_stats'
+    source = Column(String, primary_key=True)
+    source_id = Column(String, primary_key=True)
+    invalidation = Column(SQLEnum(ValidationStatus), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    seconds = Column(Float, nullable=False, default=0.0)
+
+# ORM Model for per media progress, a row is written with the chunks of every
+# processed source id, also when it produced none
+class ProcessedMedia(Base):
+    __tablename__ = 'processed_media'
+    source = Column(String, primary_key=True)
+    source_id = Column(String, primary_key=True)
+    unit_id = Column(String, index=True)
+    chunks = Column(Integer, nullable=False, default=0)
 
 # Utility to initialize (create) the database tables
 def init_db():
+    has_stats = inspect(engine).has_table(ChunkStats.__tablename__)
     Base.metadata.create_all(bind=engine)
+    _migrate()
+
+    # Databases created before the summary table existed need a backfill
+    if not has_stats:
+        with get_db_session() as session:
+            rebuild_stats(session)
+
+# Bring the schema of an existing database up to date with the models
+def _migrate():
+    with engine.begin() as conn:
+        columns = {c['name'] for c in inspect(conn).get_columns(AudioChunk.__tablename__)}
+        for name, ddl in _ADDED_COLUMNS.items():
+            if name not in columns:
+                conn.execute(text(f'ALTER TABLE audio_chunks ADD COLUMN {name} {ddl}'))
+        conn.execute(text('UPDATE audio_chunks SET duration = "end" - start WHERE duration IS NULL'))
+
+        # create_all only creates indexes together with their table
+        for index in AudioChunk.__table__.indexes:
+            index.create(conn, checkfirst=True)
+
+        if not inspect(conn).has_table('audio_chunks_fts'):
+            for ddl in _FTS_DDL:
+                conn.execute(text(ddl))
+            conn.execute(text("INSERT INTO audio_chunks_fts(audio_chunks_fts) VALUES ('rebuild')"))
+
+# Add (or with sign=-1 remove) the given chunks to the summary table, without committing
+def _update_stats(session: Session, chunks: list[AudioChunk], sign: int = 1) -> None:
+    totals = {}
+    for chunk in chunks:
+        key = (chunk.source, chunk.source_id, chunk.invalidation)
+        count, seconds = totals.get(key, (0, 0.0))
+        totals[key] = (count + sign, seconds + sign * (chunk.end - chunk.start))
+
+    for (source, source_id, invalidation), (count, seconds) in totals.items():
+        stmt = insert(ChunkStats).values(
+            source=source,
+            source_id=source_id,
+            invalidation=invalidation,
+            count=count,
+            seconds=seconds
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['source', 'source_id', 'invalidation'],
+            set_={
+                'count': ChunkStats.count + stmt.excluded.count,
+                'seconds': ChunkStats.seconds + stmt.excluded.seconds
+            }
+        )
+        session.execute(stmt)
+
+# Recompute the summary table from scratch out of audio_chunks
+def rebuild_stats(session: Session) -> None:
+    session.query(ChunkStats).delete()
+    rows = session.query(
+        AudioChunk.source,
+        AudioChunk.source_id,
+        AudioChunk.invalidation,
+        func.count(AudioChunk.id),
+        func.sum(AudioChunk.end - AudioChunk.start)
+    ).group_by(AudioChunk.source, AudioChunk.source_id, AudioChunk.invalidation)
+
+    session.add_all([
+        ChunkStats(source=source, source_id=source_id, invalidation=invalidation,
+                   count=count, seconds=seconds or 0.0)
+        for source, source_id, invalidation, count, seconds in rows
+    ])
+    session.commit()
 
 # Create (insert) a new chunk record into the database
 def create_chunk(session: Session, audio: str, text: str, source: str,
@@ -47,14 +168,22 @@ def create_chunk(session: Session, audio: str, text: str, source: str,
         source_id=source_id,
         start=start,
         end=end,
-        invalidation=invalidation
+        duration=end - start,
+        invalidation=invalidation,
+        text_hash=text_hash(text)
     )
     session.add(chunk)
+    _update_stats(session, [chunk])
     session.commit()
     session.refresh(chunk)
     return chunk
 
 def create_chunks(session: Session, source: str, source_id: str, captions: list[Caption]) -> None:
+    _add_chunks(session, source, source_id, captions)
+    session.commit()
+
+# Stage the chunks of one source_id in the session, without committing
+def _add_chunks(session: Session, source: str, source_id: str, captions: list[Caption]) -> list[AudioChunk]:
     chunks = []
     for caption in captions:
         chunk = AudioChunk(
@@ -64,12 +193,16 @@ def create_chunks(session: Session, source: str, source_id: str, captions: list[
             source_id=source_id,
             start=caption.start,
             end=caption.end,
-            invalidation=caption.status
+            duration=caption.end - caption.start,
+            invalidation=caption.status,
+            audio_hash=caption.audio_hash,
+            text_hash=text_hash(caption.text)
         )
         chunks.append(chunk)
     
     session.add_all(chunks)
-    session.commit()
+    _update_stats(session, chunks)
+    return chunks
 
 
 # Update an existing chunk record by its id
@@ -77,9 +210,13 @@ def update_chunk(session: Session, chunk_id: int, **kwargs) -> AudioChunk:
     chunk = session.query(AudioChunk).filter(AudioChunk.id == chunk_id).first()
     if not chunk:
         raise ValueError(f"Chunk with id {chunk_id} not found")
+    _update_stats(session, [chunk], sign=-1)
     for key, value in kwargs.items():
         if hasattr(chunk, key):
             setattr(chunk, key, value)
+    chunk.duration = chunk.end - chunk.start
+    chunk.text_hash = text_hash(chunk.text)
+    _update_stats(session, [chunk])
     session.commit()
     session.refresh(chunk)
     return chunk
@@ -89,6 +226,7 @@ def delete_chunk(session: Session, chunk_id: int) -> None:
     chunk = session.query(AudioChunk).filter(AudioChunk.id == chunk_id).first()
     if not chunk:
         raise ValueError(f"Chunk with id {chunk_id} not found")
+    _update_stats(session, [chunk], sign=-1)
     session.delete(chunk)
     session.commit()
 
@@ -99,6 +237,14 @@ def chunk_exists(session: Session, source_id: str, source: str) -> AudioChunk:
         AudioChunk.source == source
     )).scalar()
 
+# Whether the source id was processed, by its progress row or, for databases
+# written before progress was tracked, by its chunks
+def media_processed(session: Session, source_id: str, source: str) -> bool:
+    return session.query(exists().where(
+        ProcessedMedia.source_id == source_id,
+        ProcessedMedia.source == source
+    )).scalar() or chunk_exists(session, source_id, source)
+
 # Context manager to handle session lifecycle
 @contextmanager
 def get_db_session():
@@ -107,3 +253,75 @@ def get_db_session():
         yield session
     finally:
         session.close()
+
+
+class UnitOfWork:
+    """
+    Keeps a single session open for a whole pipeline run and groups the chunks
+    of many source ids into one transaction, committed once it holds max_rows
+    rows or is older than max_seconds. A source id only counts as processed
+    once the transaction holding its rows is committed, so after a crash the
+    uncommitted ones are simply processed again.
+    """
+
+    def __init__(self, max_rows: int = 5000, max_seconds: float = 120.0):
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.session = SessionLocal()
+        self._pending: set[tuple[str, str]] = set()
+        self._pending_rows = 0
+        self._started: Optional[float] = None
+        # Called before every commit, e.g. to complete output shards first
+        self.before_commit: list[Callable[[], None]] = []
+
+    def chunk_exists(self, source_id: str, source: str) -> bool:
+        return (source, source_id) in self._pending or media_processed(self.session, source_id, source)
+
+    def add_chunks(self, source: str, source_id: str, captions: list[Caption],
+                   unit_id: Optional[str] = None) -> None:
+        """
+        Stages all chunks of one source id together with its progress row,
+        then commits if the current transaction reached its size or time
+        bound. Captions may be empty to record a source id without chunks.
+        """
+        if self._started is None:
+            self._started = time.monotonic()
+
+        _add_chunks(self.session, source, source_id, captions)
+        self.session.merge(ProcessedMedia(source=source, source_id=source_id, unit_id=unit_id,
+                                          chunks=len(captions)))
+        self._pending.add((source, source_id))
+        self._pending_rows += len(captions)
+
+        if self._pending_rows >= self.max_rows or time.monotonic() - self._started >= self.max_seconds:
+            self.commit()
+
+    def commit(self) -> None:
+        """
+        Commits everything staged so far. Must be called before anything that
+        relies on the rows being on disk, e.g. uploading data.db.
+        """
+        if not self._pending:
+            return
+        for hook in self.before_commit:
+            hook()
+        self.session.commit()
+        logging.info(f"Committed {self._pending_rows} chunks of {len(self._pending)} source ids")
+        self._pending.clear()
+        self._pending_rows = 0
+        self._started = None
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self) -> 'UnitOfWork':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.session.rollback()
+        finally:
+            self.close()
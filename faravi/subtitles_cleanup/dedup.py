@@ -0,0 +1,102 @@
+import argparse
+import json
+from itertools import groupby
+from typing import Iterator, Optional
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from db import AudioChunk, init_db, get_db_session
+from hashing import text_hash
+from normalizer import ValidationStatus
+
+HASH_COLUMNS = {
+    'audio': AudioChunk.audio_hash,
+    'text': AudioChunk.text_hash,
+}
+
+
+def backfill_text_hashes(session: Session, batch_size: int = 10000) -> int:
+    """
+    Computes text_hash for rows written before the column existed.
+    Returns the number of updated rows.
+    """
+    updated = 0
+    last_id = 0
+    while True:
+        rows = (
+            session.query(AudioChunk.id, AudioChunk.text)
+            .filter(AudioChunk.id > last_id, AudioChunk.text_hash.is_(None))
+            .order_by(AudioChunk.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            return updated
+
+        session.bulk_update_mappings(AudioChunk, [
+            {'id': chunk_id, 'text_hash': text_hash(text)} for chunk_id, text in rows
+        ])
+        session.commit()
+        updated += len(rows)
+        last_id = rows[-1].id
+
+def duplicate_groups(session: Session, by: str = 'text',
+                     status: Optional[ValidationStatus] = ValidationStatus.VALID) -> Iterator[list[AudioChunk]]:
+    """
+    Yields groups of chunks sharing the same audio or text hash. Audio
+    hashes only match identical cuts of the same audio, see
+    exact_audio_hash, not re-cut near duplicates. Rows are read
+    once in hash order through the hash index, so each group comes out whole
+    without any pairwise comparison. Within a group the oldest chunk is first.
+    """
+    column = HASH_COLUMNS[by]
+
+    duplicated = session.query(column).filter(column.isnot(None))
+    if status is not None:
+        duplicated = duplicated.filter(AudioChunk.invalidation == status)
+    duplicated = duplicated.group_by(column).having(func.count() > 1)
+
+    rows = session.query(AudioChunk).filter(column.in_(duplicated))
+    if status is not None:
+        rows = rows.filter(AudioChunk.invalidation == status)
+    rows = rows.order_by(column, AudioChunk.id).yield_per(1000)
+
+    for _, group in groupby(rows, key=lambda chunk: getattr(chunk, column.key)):
+        yield list(group)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find chunks with duplicated audio or text')
+    parser.add_argument('--by', default='text', choices=HASH_COLUMNS.keys(),
+                        help='audio only groups identical cuts, not re-cut near duplicates')
+    parser.add_argument('--status', default='VALID', choices=[s.name for s in ValidationStatus] + ['ALL'])
+    parser.add_argument('--backfill', action='store_true', help='compute missing text hashes first')
+    parser.add_argument('--output', help='write every group as a JSON line to this file')
+    args = parser.parse_args()
+
+    status = None if args.status == 'ALL' else ValidationStatus[args.status]
+
+    init_db()
+    with get_db_session() as session:
+        if args.backfill:
+            print(f"Backfilled {backfill_text_hashes(session)} text hashes")
+
+        output = open(args.output, 'w') if args.output else None
+        n_groups = n_duplicates = duplicate_seconds = 0
+        for group in duplicate_groups(session, args.by, status):
+            n_groups += 1
+            n_duplicates += len(group) - 1
+            duplicate_seconds += sum(chunk.end - chunk.start for chunk in group[1:])
+
+            if output:
+                output.write(json.dumps({
+                    'hash': getattr(group[0], HASH_COLUMNS[args.by].key),
+                    'text': group[0].text,
+                    'chunks': [[chunk.id, chunk.source, chunk.source_id, chunk.audio] for chunk in group]
+                }, ensure_ascii=False) + '\n')
+
+        if output:
+            output.close()
+
+        print(f"{n_groups} duplicate groups, {n_duplicates} redundant chunks, "
+              f"{duplicate_seconds / 3600:.2f} redundant hours")
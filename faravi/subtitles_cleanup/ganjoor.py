@@ -1,193 +1,183 @@
 import tarfile
-import shutil
-from huggingface_hub import HfApi
-from os.path import join, basename, isdir
-import json
-from os import makedirs, listdir, remove
-from tenacity import retry, stop_after_attempt, wait_fixed
-from normalizer import ValidationStatus
 import re
-
-from chunker import AudioChunker, Caption
-from db import create_chunks, init_db, get_db_session, chunk_exists
+from dataclasses import dataclass, field
+from os.path import join, basename
+from os import listdir, remove
+from typing import Dict, List, Optional
+import numpy as np
+
+from chunker import Caption
+from sources import SourceAdapter, Unit, Media, stream_tar_pairs, open_tar_files
+from runner import main
 from utils import SingletonLogger
 
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
 logger = SingletonLogger().get_logger()
 
-hf_api = HfApi()
-chunker = AudioChunker()
-repo_id = 'farsi-asr/ganjoor-dataset'
-target_repo_id = 'farsi-asr/ganjoor-chunked-asr-dataset'
-tmp_dir = 'tmp'
+# Problems that mean the timeline of the whole file is unusable
+FILE_REJECTIONS = ('zero start', 'zero end')
+
+
+@dataclass
+class Timeline:
+    """
+    Captions of a file as columns: start and end in seconds, and texts.
+    """
+    start: np.ndarray
+    end: np.ndarray
+    text: List[str]
+
+    def __len__(self) -> int:
+        return len(self.text)
+
+    def captions(self) -> List[Caption]:
+        return [
+            Caption(start=start, end=end, text=text)
+            for start, end, text in zip(self.start.tolist(), self.end.tolist(), self.text)
+        ]
+
+
+@dataclass
+class LoadReport:
+    """
+    What load_timeline rejected: cue indices by reason, and the reason the
+    whole file was rejected, if it was.
+    """
+    path: str
+    total: int = 0
+    rejected: Dict[str, List[int]] = field(default_factory=dict)
+    file_rejected: Optional[str] = None
+
+    def log(self) -> None:
+        if self.file_rejected:
+            logger.warning(f"{self.path} rejected: {self.file_rejected}")
+        elif self.rejected:
+            details = ', '.join(f"{reason}: {indices[:10]}" for reason, indices in self.rejected.items())
+            n_rejected = sum(len(indices) for indices in self.rejected.values())
+            logger.warning(f"{self.path}: rejected {n_rejected} of {self.total} cues ({details})")
+
+
+def _column(cues: list, key: str) -> np.ndarray:
+    """
+    Values of key over all cues as floats, NaN where missing or not a number.
+    """
+    values = [cue.get(key) if isinstance(cue, dict) else None for cue in cues]
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        # only for files with stray non numeric values
+        column = np.full(len(values), np.nan)
+        for i, value in enumerate(values):
+            try:
+                column[i] = float(value)
+            except (TypeError, ValueError):
+                pass
+        return column
+
+def load_timeline(sub_path: str, strict: bool = True) -> tuple[Timeline, LoadReport]:
+    """
+    Loads a ganjoor caption file into a Timeline and validates all cues at
+    once. Cues come with 'end' in seconds or 'endTime' in milliseconds.
+    Cues without start, end or text, or ending before they start, are
+    dropped. A zero start after the first cue or a zero end means the file
+    is out of sync; with strict the whole file is then rejected.
+    """
+    report = LoadReport(sub_path)
+    empty = Timeline(np.zeros(0), np.zeros(0), [])
 
-def get_captions(sub_path):
     try:
-        with open(sub_path, 'r') as f:
-            captions_dict = json.load(f)
+        with open(sub_path, 'rb') as f:
+            cues = _loads(f.read())
     except Exception as e:
-        logger.error(f"Error reading subtitles from {sub_path}: {e}")
-        return []
-
-    captions = []
-    for i, caption in enumerate(captions_dict):
-        # check if all values are present
-        if not all(k in caption.keys() for k in ['start', 'text']):
-            logger.error(f"Invalid caption: {caption}")
-            continue
-        
-        if caption['start'] == 0 and i != 0:
-            logger.warning(f"{sub_path} invalid start = 0")
-            return []
-        
-        if 'endTime' in caption.keys():
-            if caption['endTime'] == 0:
-                logger.warning(f"{sub_path} invalid endTime = 0")
-                return []
-            
-            
-            captions.append(
-                Caption(
-                    start=caption['start'],
-                    end=int(caption['endTime']) / 1000,
-                    text=caption['text']
-                )
-            )
-        else:
-            if caption['end'] == 0:
-                logger.warning(f"{sub_path} invalid end = 0")
-                return []
-
-            captions.append(
-                Caption(
-                    start=caption['start'],
-                    end=caption['end'],
-                    text=caption['text']
-                )
-            )
-
-    return captions
-
-@retry(stop=stop_after_attempt(10), wait=wait_fixed(600))
-def upload_results():
-    hf_api.upload_folder(
-        repo_id=target_repo_id,
-        folder_path='upload',
-        repo_type='dataset'
-    )
-    logger.info(f"Uploaded archive and db files to target repo")
-
-@retry(stop=stop_after_attempt(10), wait=wait_fixed(600))
-def _download_tar_file(tar_file):
-    return hf_api.hf_hub_download(
-        repo_id, tar_file, repo_type='dataset', local_dir=tmp_dir
-    )
-
-list_repo_files = hf_api.list_repo_files(target_repo_id, repo_type='dataset')
-def download_and_extract_tar_file(tar_file: str):
-    if basename(tar_file) in list_repo_files:
-        return None
-
-    artist_id = basename(tar_file).replace('.tar.gz', '')
+        report.file_rejected = f"unreadable: {e}"
+        return empty, report
+    if not isinstance(cues, list):
+        report.file_rejected = "not a list of cues"
+        return empty, report
+
+    report.total = len(cues)
+    start = _column(cues, 'start')
+    end_time = _column(cues, 'endTime')
+    end = np.where(np.isnan(end_time), _column(cues, 'end'), end_time / 1000)
+    text = [cue.get('text') if isinstance(cue, dict) else None for cue in cues]
+
+    has_text = np.array([isinstance(t, str) for t in text], dtype=bool)
+    index = np.arange(len(cues))
+    problems = {
+        'missing start or text': np.isnan(start) | ~has_text,
+        'missing end': np.isnan(end),
+        'zero start': (start == 0) & (index != 0),
+        'zero end': end == 0,
+        'end before start': end < start,
+    }
+
+    valid = np.ones(len(cues), dtype=bool)
+    for reason, mask in problems.items():
+        if mask.any():
+            report.rejected[reason] = np.flatnonzero(mask).tolist()
+            valid &= ~mask
+
+    if strict:
+        for reason in FILE_REJECTIONS:
+            if reason in report.rejected:
+                report.file_rejected = f"{reason} at cue {report.rejected[reason][0]}"
+                return empty, report
+
+    keep = np.flatnonzero(valid)
+    return Timeline(start[keep], end[keep], [text[i] for i in keep]), report
 
-    try:
-        tar_path = _download_tar_file(tar_file)
+def get_captions(sub_path):
+    timeline, report = load_timeline(sub_path)
+    report.log()
+    return timeline.captions()
+
+
+class GanjoorSource(SourceAdapter):
+    name = 'ganjoor'
+    repo_id = 'farsi-asr/ganjoor-dataset'
+    target_repo_id = 'farsi-asr/ganjoor-chunked-asr-dataset'
+    merge = False
+
+    def list_units(self, hub):
+        tar_files = hub.list_repo_files(self.repo_id, repo_type='dataset')
+        tar_files = [f for f in tar_files if re.match(r'^ganjoor/[a-zA-Z0-9-]+\.tar\.gz$', f)]
+        logger.info(f"Found {len(tar_files)} tar.gz files in repository {self.repo_id}.")
+        return [Unit(basename(f).replace('.tar.gz', ''), [f]) for f in tar_files]
+
+    def is_uploaded(self, unit, target_files):
+        return super().is_uploaded(unit, target_files) or f'{unit.id}.tar.gz' in target_files
+
+    def fetch(self, hub, unit, work_dir):
+        tar_file = unit.files[0]
+        tar_path = self.download_file(hub, tar_file, work_dir)
         logger.info(f"Downloaded {tar_file}")
-    except Exception as e:
-        logger.error(f"Error downloading {tar_file}: {e}")
-        shutil.rmtree(tmp_dir, ignore_errors=True)
-        return None
 
-    try:
-        tar_dir = join(tmp_dir, artist_id)
-        makedirs(tar_dir, exist_ok=True)
+        tar_dir = join(work_dir, unit.id)
         with tarfile.open(tar_path, 'r:gz') as tar:
             tar.extractall(tar_dir)
-        logger.info(f"Extracted {tar_file} into {tmp_dir}")
-    except Exception as e:
-        logger.error(f"Error extracting {tar_file}: {e}")
-        shutil.rmtree(tmp_dir, ignore_errors=True)
-        return None
+        remove(tar_path)
+        logger.info(f"Extracted {tar_file} into {tar_dir}")
+
+        file_ids = [f.split('.')[0] for f in listdir(tar_dir) if f.endswith('mp3')]
+        return [
+            Media(file_id, join(tar_dir, file_id + '.mp3'), join(tar_dir, file_id + '.json'))
+            for file_id in file_ids
+        ]
+
+    def stream(self, hub, unit, work_dir):
+        # audio and subtitles of a file share its name in the tar
+        pairs = stream_tar_pairs(open_tar_files(hub, self.repo_id, unit.files), join(work_dir, unit.id),
+                                 audio_ext='.mp3', sub_ext='.json', key=lambda name: name.rsplit('.', 1)[0])
+        for audio_path, sub_path in pairs:
+            yield Media(basename(audio_path).split('.')[0], audio_path, sub_path)
+
+    def get_captions(self, media):
+        return get_captions(media.sub_path)
 
-    return artist_id
 
 if __name__ == '__main__':
-    # check if db exists in target repo
-    if 'data.db' not in hf_api.list_repo_files(target_repo_id, repo_type='dataset'):
-        logger.info("Initializing database...")
-        init_db()
-    else:
-        hf_api.hf_hub_download(
-            target_repo_id, 'data.db', repo_type='dataset', local_dir='.'
-        )
-        logger.info("Downloaded database")
-
-    # Get youtube tar files from repo
-    tar_files = hf_api.list_repo_files(repo_id, repo_type='dataset')
-    tar_files = [f for f in tar_files if re.match(r'^ganjoor/[a-zA-Z0-9-]+\.tar\.gz$', f)]
-    logger.info(f"Found {len(tar_files)} tar.gz files in repository {repo_id}.")
-    
-    for tar_file in tar_files:
-        makedirs(tmp_dir, exist_ok=True)
-
-        artist_id = download_and_extract_tar_file(tar_file)
-        if not artist_id:
-            logger.info(f'Already processed {artist_id}. Skipping.')
-            continue
-
-        file_ids = listdir(join(tmp_dir, artist_id))
-        file_ids = [f.split('.')[0] for f in file_ids if f.endswith('mp3')]
-        for file_id in file_ids:
-            logger.info(f"Processing video ID: {file_id}")
-
-            audio_file = file_id + '.mp3'
-            sub_file = file_id + '.json'
-
-            with get_db_session() as session:
-                if chunk_exists(session, file_id, 'ganjoor'):
-                    logger.info(f"Already processed {audio_file}. Skipping.")
-                    continue
-
-            audio_path = join(tmp_dir, artist_id, audio_file)
-            sub_path = join(tmp_dir, artist_id, sub_file)
-
-            output_dir = join(artist_id, file_id)
-            makedirs(output_dir, exist_ok=True)
-
-            captions = get_captions(sub_path)
-            if not captions:
-                continue
-
-            processed_captions = chunker.chunk(
-                merge=False,
-                audio_file=audio_path,
-                captions=captions,
-                output_dir=output_dir
-            )
-            logger.info(
-                f"Created {len(processed_captions)} audio chunks for {file_id}")
-
-            with get_db_session() as session:
-                create_chunks(session, 'ganjoor', file_id, processed_captions)
-            logger.info(
-                f"Recorded processed chunks in the database for {file_id}")
-
-        if not isdir(artist_id):
-            shutil.rmtree(tmp_dir, ignore_errors=True)
-            logger.warning(
-                f"No chunks created for channel {artist_id}. Skipping.")
-            continue
-
-        # create archive and upload to target repo
-        archive_path = shutil.make_archive(artist_id, 'gztar', root_dir='.', base_dir=artist_id)
-        logger.info(f"Created archive {archive_path}")
-
-        makedirs('upload', exist_ok=True)
-        shutil.copy('data.db', join('upload', 'data.db'))
-        shutil.move(archive_path, join('upload', basename(archive_path)))
-        upload_results()
-        shutil.rmtree('upload', ignore_errors=True)
-
-
-        # cleanup
-        shutil.rmtree(tmp_dir, ignore_errors=True)
-        shutil.rmtree(artist_id, ignore_errors=True)
+    main(GanjoorSource())
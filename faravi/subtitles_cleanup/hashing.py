@@ -0,0 +1,45 @@
+import hashlib
+import re
+import unicodedata
+from typing import Optional
+import numpy as np
+
+FINGERPRINT_FRAME = 0.1     # seconds per energy frame
+FINGERPRINT_MIN_DELTA = 0.5  # dB, smaller energy changes count as flat
+
+_non_word_pattern = re.compile(r'[\W_]+')
+
+
+def text_hash(text: str) -> Optional[str]:
+    """
+    Hashes the text after dropping punctuation, ZWNJs, spaces and case, so
+    repeated subtitle lines hash equally. Returns None for empty text.
+    """
+    text = _non_word_pattern.sub('', unicodedata.normalize('NFKC', text).lower())
+    if not text:
+        return None
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def exact_audio_hash(samples: np.ndarray, sample_rate: int) -> Optional[str]:
+    """
+    Hashes audio by the rise/fall pattern of its short-time energy, so the
+    same cut hashes equally across gain changes and mild re-encodes. This
+    only finds exact duplicates: the frames are not aligned to the content,
+    so a shift of a few samples or a slightly different cut of the same
+    audio gives a different hash. Returns None if the audio is shorter than
+    two frames.
+    """
+    frame = int(FINGERPRINT_FRAME * sample_rate)
+    n_frames = len(samples) // frame
+    if n_frames < 2:
+        return None
+
+    frames = samples[:n_frames * frame].reshape(n_frames, frame).astype(np.float64)
+    energy = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+
+    delta = np.diff(energy)
+    pattern = np.sign(delta) * (np.abs(delta) >= FINGERPRINT_MIN_DELTA)
+    pattern = (pattern + 1).astype(np.uint8)  # 0 falling, 1 flat, 2 rising
+
+    return hashlib.blake2b(pattern.tobytes(), digest_size=16).hexdigest()
@@ -0,0 +1,218 @@
+import json
+import os
+import shutil
+import time
+from fnmatch import fnmatch
+from threading import Lock
+from typing import Optional, Union
+from huggingface_hub import HfApi, hf_hub_url
+from huggingface_hub.utils import build_hf_headers, filter_repo_objects, get_session
+
+from blobs import BlobCache
+
+
+class LocalHub:
+    """
+    Stand-in for HfApi backed by a local directory, one sub directory per
+    repo id, for running the drivers without network access. Implements the
+    subset of the HfApi interface the drivers use.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _repo_dir(self, repo_id: str) -> str:
+        return os.path.join(self.root, repo_id)
+
+    def open_file(self, repo_id: str, filename: str, repo_type: Optional[str] = None):
+        return open(os.path.join(self._repo_dir(repo_id), filename), 'rb')
+
+    def list_repo_files(self, repo_id: str, repo_type: Optional[str] = None) -> list[str]:
+        repo_dir = self._repo_dir(repo_id)
+        files = []
+        for dirpath, _, filenames in os.walk(repo_dir):
+            for filename in filenames:
+                files.append(os.path.relpath(os.path.join(dirpath, filename), repo_dir).replace(os.sep, '/'))
+        return sorted(files)
+
+    def hf_hub_download(self, repo_id: str, filename: str, repo_type: Optional[str] = None,
+                        local_dir: str = '.') -> str:
+        source = os.path.join(self._repo_dir(repo_id), filename)
+        if not os.path.isfile(source):
+            raise FileNotFoundError(f"{filename} not found in {repo_id}")
+
+        target = os.path.join(local_dir, filename)
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        shutil.copyfile(source, target)
+        return target
+
+    def snapshot_download(self, repo_id: str, repo_type: Optional[str] = None, local_dir: str = '.',
+                          allow_patterns: Optional[Union[str, list[str]]] = None) -> str:
+        if isinstance(allow_patterns, str):
+            allow_patterns = [allow_patterns]
+
+        for filename in self.list_repo_files(repo_id):
+            if allow_patterns is None or any(fnmatch(filename, p) for p in allow_patterns):
+                self.hf_hub_download(repo_id, filename, local_dir=local_dir)
+        return local_dir
+
+    def upload_file(self, path_or_fileobj: str, path_in_repo: str, repo_id: str,
+                    repo_type: Optional[str] = None) -> None:
+        target = os.path.join(self._repo_dir(repo_id), path_in_repo)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(path_or_fileobj, target)
+
+    def upload_folder(self, repo_id: str, folder_path: str, repo_type: Optional[str] = None,
+                      path_in_repo: Optional[str] = None) -> None:
+        target = os.path.join(self._repo_dir(repo_id), path_in_repo or '')
+        shutil.copytree(folder_path, target, dirs_exist_ok=True)
+
+
+class CachedHub:
+    """
+    Wraps a hub client (HfApi, LocalHub or any fake with the same methods)
+    and caches repo file listings for ttl seconds in a JSON file, so they
+    survive between runs. Our own uploads invalidate the listing of their
+    repo; everything else is passed through to the client.
+
+    With a BlobCache, downloads are also served from and added to it.
+    """
+
+    def __init__(self, client, cache_path: Optional[str] = 'hub_cache.json', ttl: float = 3600.0,
+                 blobs: Optional[BlobCache] = None):
+        self.client = client
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.blobs = blobs
+        self._lock = Lock()
+        self._listings: dict[str, dict] = self._load()
+        self._sets: dict[str, frozenset[str]] = {}
+
+    def __getattr__(self, name: str):
+        # guard against recursion while client is not set yet, e.g. on unpickling
+        if name == 'client':
+            raise AttributeError(name)
+        return getattr(self.client, name)
+
+    def _load(self) -> dict[str, dict]:
+        if not self.cache_path or not os.path.isfile(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, 'r') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            return {}
+
+    def _save(self) -> None:
+        if not self.cache_path:
+            return
+        with open(self.cache_path + '.tmp', 'w') as f:
+            json.dump(self._listings, f)
+        os.replace(self.cache_path + '.tmp', self.cache_path)
+
+    def list_repo_files(self, repo_id: str, repo_type: Optional[str] = None) -> list[str]:
+        key = f'{repo_type}:{repo_id}'
+        with self._lock:
+            listing = self._listings.get(key)
+            if listing is None or time.time() - listing['time'] > self.ttl:
+                listing = {'time': time.time(), 'files': self.client.list_repo_files(repo_id, repo_type=repo_type)}
+                self._listings[key] = listing
+                self._sets.pop(key, None)
+                self._save()
+            return listing['files']
+
+    def repo_files(self, repo_id: str, repo_type: Optional[str] = None) -> frozenset[str]:
+        """
+        The cached listing as a set, for membership checks.
+        """
+        files = self.list_repo_files(repo_id, repo_type)
+        key = f'{repo_type}:{repo_id}'
+        with self._lock:
+            if key not in self._sets:
+                self._sets[key] = frozenset(files)
+            return self._sets[key]
+
+    def invalidate(self, repo_id: str, repo_type: Optional[str] = None) -> None:
+        key = f'{repo_type}:{repo_id}'
+        with self._lock:
+            self._sets.pop(key, None)
+            if self._listings.pop(key, None) is not None:
+                self._save()
+
+    def hf_hub_download(self, repo_id: str, filename: str, repo_type: Optional[str] = None,
+                        local_dir: str = '.', use_cache: bool = True) -> str:
+        """
+        Downloads one file, through the blob cache unless use_cache is
+        False, which files that change between runs must set.
+        """
+        if self.blobs is None or not use_cache:
+            return self.client.hf_hub_download(repo_id, filename, repo_type=repo_type, local_dir=local_dir)
+
+        def download(tmp_dir):
+            return self.client.hf_hub_download(repo_id, filename, repo_type=repo_type, local_dir=tmp_dir)
+
+        return self.blobs.fetch(repo_id, filename, repo_type, local_dir, download)
+
+    def snapshot_download(self, repo_id: str, repo_type: Optional[str] = None, local_dir: str = '.',
+                          allow_patterns: Optional[Union[str, list[str]]] = None) -> str:
+        if self.blobs is None:
+            return self.client.snapshot_download(repo_id, repo_type=repo_type, local_dir=local_dir,
+                                                 allow_patterns=allow_patterns)
+
+        # file by file, so every file goes through the blob cache
+        files = self.list_repo_files(repo_id, repo_type)
+        for filename in filter_repo_objects(files, allow_patterns=allow_patterns):
+            self.hf_hub_download(repo_id, filename, repo_type=repo_type, local_dir=local_dir)
+        return local_dir
+
+    def upload_file(self, path_or_fileobj: str, path_in_repo: str, repo_id: str,
+                    repo_type: Optional[str] = None, **kwargs) -> None:
+        try:
+            return self.client.upload_file(path_or_fileobj=path_or_fileobj, path_in_repo=path_in_repo,
+                                           repo_id=repo_id, repo_type=repo_type, **kwargs)
+        finally:
+            self.invalidate(repo_id, repo_type)
+
+    def upload_folder(self, repo_id: str, folder_path: str, repo_type: Optional[str] = None, **kwargs) -> None:
+        try:
+            return self.client.upload_folder(repo_id=repo_id, folder_path=folder_path,
+                                             repo_type=repo_type, **kwargs)
+        finally:
+            self.invalidate(repo_id, repo_type)
+
+
+def open_file(hub, repo_id: str, filename: str, repo_type: str = 'dataset'):
+    """
+    Opens a repo file as a binary stream that is read straight from the
+    network, without saving it to disk. With a blob cache, a cached file is
+    read from the cache, and a file streamed in full is added to it.
+    """
+    blobs = None
+    if isinstance(hub, CachedHub):
+        blobs = hub.blobs
+        blob = blobs and blobs.lookup(repo_id, filename, repo_type)
+        if blob:
+            return open(blob, 'rb')
+        hub = hub.client
+
+    if isinstance(hub, LocalHub):
+        stream = hub.open_file(repo_id, filename, repo_type)
+    else:
+        url = hf_hub_url(repo_id, filename, repo_type=repo_type)
+        response = get_session().get(url, headers=build_hf_headers(token=hub.token), stream=True, timeout=60)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        stream = response.raw
+    return blobs.tee(repo_id, filename, repo_type, stream) if blobs else stream
+
+
+def get_hub(local_root: Optional[str] = None, listing_ttl: float = 3600.0,
+            cache_path: Optional[str] = 'hub_cache.json', blob_dir: Optional[str] = None,
+            blob_gb: float = 100.0) -> CachedHub:
+    """
+    Returns the Hugging Face client, or a LocalHub if a local root is given,
+    with cached listings and, if blob_dir is given, cached downloads.
+    """
+    client = LocalHub(local_root) if local_root else HfApi()
+    blobs = BlobCache(blob_dir, int(blob_gb * 1024 ** 3)) if blob_dir else None
+    return CachedHub(client, cache_path, listing_ttl, blobs)
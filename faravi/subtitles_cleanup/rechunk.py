@@ -0,0 +1,150 @@
+import argparse
+import os
+import shutil
+from os.path import join
+from typing import List, Optional
+
+from chunk_pool import ChunkingPool, worker_chunker
+from chunker import AudioChunker, Caption
+from db import AudioChunk, ProcessedMedia, init_db, get_db_session
+from ganjoor import GanjoorSource
+from hub import get_hub
+from movies import MoviesSource
+from normalizer import ValidationStatus
+from shards import ShardWriter, SampleBuffer
+from sources import SourceAdapter, Unit
+from youtube import YouTubeSource
+from utils import SingletonLogger
+
+logger = SingletonLogger().get_logger()
+
+SOURCES = {source.name: source for source in (YouTubeSource, MoviesSource, GanjoorSource)}
+
+
+def _slice_in_worker(audio_path: str, captions: List[Caption]) -> SampleBuffer:
+    buffer = SampleBuffer()
+    worker_chunker().slice(audio_path, captions, writer=buffer)
+    return buffer
+
+
+class Rechunker:
+    """
+    Re-encodes the chunks of a source from the rows already in the
+    database, e.g. with another codec or sample rate. Captions are neither
+    parsed nor normalized again: the rows give the final start, end, text
+    and status, and only rows with the requested statuses are encoded.
+
+    Every unit is written to {output_dir}/{unit}.part and renamed once
+    complete, so completed units are skipped when the run is restarted.
+    Sample keys are the stems of the original audio filenames.
+    """
+
+    def __init__(self, adapter: SourceAdapter, hub=None, statuses: Optional[List[ValidationStatus]] = None,
+                 output_dir: str = 'rechunked', tmp_dir: str = 'tmp', workers: int = 1, **options):
+        self.adapter = adapter
+        self.hub = hub or get_hub()
+        self.statuses = statuses or [ValidationStatus.VALID]
+        self.output_dir = output_dir
+        self.tmp_dir = tmp_dir
+        self.workers = workers
+        self.options = options
+
+    def _captions(self, session, source_id: str) -> List[Caption]:
+        rows = (
+            session.query(AudioChunk)
+            .filter(AudioChunk.source == self.adapter.name,
+                    AudioChunk.source_id == source_id,
+                    AudioChunk.invalidation.in_(self.statuses))
+            .order_by(AudioChunk.start)
+            .all()
+        )
+        return [
+            Caption(row.start, row.end, row.text, row.invalidation,
+                    row.audio or f'{source_id}_{row.id}')
+            for row in rows
+        ]
+
+    def _units(self, session) -> List[Unit]:
+        units = self.adapter.list_units(self.hub)
+
+        # units recorded in the progress table, if the database tracks them
+        recorded = {
+            unit_id for unit_id, in
+            session.query(ProcessedMedia.unit_id).filter(ProcessedMedia.source == self.adapter.name).distinct()
+        }
+        if recorded:
+            units = [unit for unit in units if unit.id in recorded]
+        return units
+
+    def _rechunk_unit(self, session, pool: ChunkingPool, unit: Unit) -> None:
+        final_dir = join(self.output_dir, unit.id)
+        part_dir = final_dir + '.part'
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+        work_dir = join(self.tmp_dir, unit.id)
+        os.makedirs(work_dir, exist_ok=True)
+        try:
+            media = self.adapter.fetch(self.hub, unit, work_dir)
+            writer = ShardWriter(part_dir, unit.id)
+
+            def drain(limit=None):
+                for _, future in pool.completed(limit):
+                    future.result().replay(writer)
+                    if writer.full:
+                        writer.flush()
+
+            for item in media:
+                captions = self._captions(session, item.id)
+                if not captions:
+                    continue
+                pool.submit(item, _slice_in_worker, item.audio_path, captions)
+                drain()
+            drain(0)
+            writer.close()
+        finally:
+            pool.discard()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        os.replace(part_dir, final_dir)
+        logger.info(f"Re-chunked {writer.count} samples of {unit.id}")
+
+    def run(self) -> None:
+        init_db()
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        with get_db_session() as session, \
+                ChunkingPool(self.workers, fingerprint=False, **self.options) as pool:
+            for unit in self._units(session):
+                if os.path.isdir(join(self.output_dir, unit.id)):
+                    logger.info(f"{unit.id} already re-chunked. Skipping.")
+                    continue
+                try:
+                    self._rechunk_unit(session, pool, unit)
+                except Exception as e:
+                    logger.error(f"Error re-chunking {unit.id}: {e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Re-encode chunks from the rows in data.db')
+    parser.add_argument('source', choices=SOURCES.keys())
+    parser.add_argument('--status', nargs='+', default=['VALID'], choices=[s.name for s in ValidationStatus],
+                        help='only rows with these statuses are encoded')
+    parser.add_argument('--codec', default='mp3', choices=AudioChunker.CODECS.keys())
+    parser.add_argument('--sample-rate', type=int, default=48000)
+    parser.add_argument('--bitrate', default='64k')
+    parser.add_argument('--output', default='rechunked', help='directory the shards are written to')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--hub-dir', help='local directory standing in for the hub, for testing')
+    parser.add_argument('--blob-cache-dir', help='serve source files from this download cache')
+    args = parser.parse_args()
+
+    Rechunker(
+        SOURCES[args.source](),
+        get_hub(args.hub_dir, blob_dir=args.blob_cache_dir),
+        statuses=[ValidationStatus[s] for s in args.status],
+        output_dir=args.output,
+        workers=args.workers,
+        sample_rate=args.sample_rate,
+        bitrate=args.bitrate,
+        codec=args.codec
+    ).run()
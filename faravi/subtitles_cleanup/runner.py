@@ -0,0 +1,486 @@
+import argparse
+import os
+import shutil
+import socket
+from os.path import isdir, join
+from os import makedirs, remove
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Thread, Event
+from typing import Collection, Iterable, Iterator, List, Optional
+
+from acoustic import AcousticClassifier
+from chunk_pool import ChunkingPool, worker_chunker
+from chunker import AudioChunker, Caption, ChunkingError
+from db import init_db, UnitOfWork
+from hub import CachedHub, get_hub
+from normalizer import ValidationStatus
+from segmentation import OverlapDetector
+from shards import ShardWriter, SampleBuffer
+from sources import SourceAdapter, Unit, Media, hub_retry
+from workqueue import WorkQueue, SQLiteWorkQueue, DirectoryWorkQueue
+from utils import SingletonLogger
+
+logger = SingletonLogger().get_logger()
+
+
+def disk_usage(*paths):
+    """
+    Returns the total size in bytes of all files under the given paths.
+    """
+    total = 0
+    for path in paths:
+        for dirpath, _, filenames in os.walk(path):
+            total += sum(os.path.getsize(join(dirpath, f)) for f in filenames)
+    return total
+
+
+def _chunk_in_worker(adapter: SourceAdapter, item: Media,
+                     encode_statuses: Optional[Collection[ValidationStatus]] = None
+                     ) -> Optional[tuple[List[Caption], SampleBuffer]]:
+    """
+    Parses and chunks one media in a worker process. The encoded samples are
+    sent back to the parent, the only process writing shards and rows.
+    """
+    captions = adapter.get_captions(item)
+    if not captions:
+        return None
+
+    buffer = SampleBuffer()
+    processed_captions = worker_chunker().chunk(
+        merge=adapter.merge,
+        audio_file=item.audio_path,
+        captions=captions,
+        writer=buffer,
+        encode_statuses=encode_statuses
+    )
+    return processed_captions, buffer
+
+
+class Runner:
+    """
+    Runs a source through download, chunking and upload. Three stages
+    overlap: the next units download while the current one is chunked, and
+    the previous one uploads in the background.
+
+    With stream set, archives are read straight from the download stream
+    instead of being saved and extracted whole, and each media is handed to
+    the chunker as soon as its files arrive, then deleted once chunked.
+
+    With workers above 1, the media of a unit are chunked in a process pool
+    while this process stays the single writer of shards and rows.
+
+    With a work queue, several nodes share the units: each unit is leased
+    before it is fetched, the lease is renewed while the node works on it,
+    and the unit is completed in the queue once its upload is done. Every
+    node then keeps its own database, uploaded as data-{node}.db. A unit
+    whose lease is lost, e.g. after a long stall, is not worked on further:
+    another node may hold it by then.
+    """
+
+    def __init__(self, adapter: SourceAdapter, hub=None, prefetch: int = 1, max_disk_gb: float = 50.0,
+                 tmp_dir: str = 'tmp', uploads_dir: str = 'uploads', stream: bool = False,
+                 workers: int = 1, queue: Optional[WorkQueue] = None,
+                 encode_statuses: Optional[Collection[ValidationStatus]] = None,
+                 refine_window: float = 0.0, classify: bool = False, overlap_model: bool = False):
+        self.adapter = adapter
+        self.encode_statuses = encode_statuses
+        self.queue = queue
+        self.db_name = f'data-{queue.node}.db' if queue else 'data.db'
+        self._held: set[str] = set()
+        self._lost: set[str] = set()
+        self.stream = stream
+        self.workers = workers
+        self._pool: Optional[ChunkingPool] = None
+        # any client with the HfApi interface can be injected, e.g. a LocalHub
+        self.hub = hub if isinstance(hub, CachedHub) else CachedHub(hub) if hub else get_hub()
+        self.prefetch = prefetch
+        self.max_disk_bytes = max_disk_gb * 1024 ** 3
+        self.tmp_dir = tmp_dir
+        self.uploads_dir = uploads_dir
+        # the same options build the chunker of every pool worker
+        classifier = None
+        if classify:
+            classifier = AcousticClassifier(overlap=OverlapDetector().overlaps if overlap_model else None)
+        self.chunker_options = dict(refine_window=refine_window, classifier=classifier)
+        self.chunker = AudioChunker(**self.chunker_options)
+
+    def _prepare_db(self) -> None:
+        # shards of an unfinished unit are only consistent with the local db
+        if os.path.isfile('data.db') and os.path.isdir(self.uploads_dir) and os.listdir(self.uploads_dir):
+            logger.info("Resuming unfinished units with the local database")
+        # check if db exists in target repo, never trusting a cached listing
+        # here since other nodes may have uploaded since
+        elif not self._target_has(self.db_name, refresh=True):
+            logger.info("Initializing database...")
+        else:
+            db_path = hub_retry(self.hub.hf_hub_download)(
+                self.adapter.target_repo_id, self.db_name, repo_type='dataset', local_dir='.', use_cache=False
+            )
+            if self.db_name != 'data.db':
+                shutil.move(db_path, 'data.db')
+            logger.info("Downloaded database")
+        # also creates tables added since the database was first uploaded
+        init_db()
+
+    def _target_has(self, filename: str, refresh: bool = False) -> bool:
+        if refresh:
+            self.hub.invalidate(self.adapter.target_repo_id, repo_type='dataset')
+        return filename in self.hub.repo_files(self.adapter.target_repo_id, repo_type='dataset')
+
+    def _fetch(self, unit: Unit) -> Optional[Iterable[Media]]:
+        target_files = self.hub.repo_files(self.adapter.target_repo_id, repo_type='dataset')
+        if self.adapter.is_uploaded(unit, target_files):
+            return None
+        if not unit.files:
+            # everything was chunked before, the resumed shards may still need uploading
+            return []
+
+        work_dir = join(self.tmp_dir, unit.id)
+        makedirs(work_dir, exist_ok=True)
+        if self.stream:
+            return self._start_stream(unit, work_dir)
+        return self.adapter.fetch(self.hub, unit, work_dir)
+
+    def _start_stream(self, unit: Unit, work_dir: str) -> Iterator[Media]:
+        """
+        Starts streaming the unit in the background, keeping at most one
+        media ready ahead of the consumer, and returns the media iterator.
+        """
+        items = Queue(maxsize=1)
+
+        def produce():
+            try:
+                for item in self.adapter.stream(self.hub, unit, work_dir):
+                    items.put(item)
+                items.put(None)
+            except Exception as e:
+                items.put(e)
+
+        Thread(target=produce, daemon=True).start()
+
+        def consume():
+            while True:
+                item = items.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+
+        return consume()
+
+    def _process(self, uow: UnitOfWork, unit: Unit, media: Iterable[Media]) -> tuple[bool, Optional[str]]:
+        """
+        Chunks every media of a fetched unit into its shards and commits
+        their rows. Returns whether the unit was read completely, and the
+        upload directory or None if nothing was chunked. Shards of an
+        incomplete unit stay on disk and the next run resumes them.
+        """
+        upload_dir = join(self.uploads_dir, unit.id)
+
+        # chunks are streamed into the unit shards, which are
+        # completed before every commit of their rows
+        writer = ShardWriter(join(upload_dir, unit.id), unit.id)
+        uow.before_commit.append(writer.flush)
+
+        # media that failed to chunk are not recorded, the unit stays
+        # unfinished and only they are chunked again when it is resumed
+        failed = []
+
+        def drain(limit=None):
+            for item, future in self._pool.completed(limit):
+                try:
+                    try:
+                        result = future.result()
+                    except ChunkingError as e:
+                        logger.error(f"{e}. {item.id} will be retried.")
+                        failed.append(item.id)
+                        continue
+                    if result is None:
+                        logger.warning(f"No captions extracted from {item.sub_path}.")
+                        self._record(uow, writer, unit, item, [])
+                        continue
+                    processed_captions, buffer = result
+                    buffer.replay(writer)
+                    self._record(uow, writer, unit, item, processed_captions)
+                finally:
+                    self._cleanup(item)
+
+        complete = True
+        try:
+            for item in media:
+                if unit.id in self._lost:
+                    logger.warning(f"Stopping work on {unit.id}, its lease was lost")
+                    complete = False
+                    break
+                if uow.chunk_exists(item.id, self.adapter.name):
+                    logger.info(f"{item.id} already processed. Skipping.")
+                    self._cleanup(item)
+                elif self._pool is not None:
+                    self._pool.submit(item, _chunk_in_worker, self.adapter, item, self.encode_statuses)
+                    drain()
+                else:
+                    try:
+                        self._process_media(uow, writer, unit, item)
+                    except ChunkingError as e:
+                        logger.error(f"{e}. {item.id} will be retried.")
+                        failed.append(item.id)
+                    finally:
+                        self._cleanup(item)
+            if self._pool is not None:
+                drain(0)
+        except Exception as e:
+            logger.error(f"Error reading {unit.id}: {e}")
+            complete = False
+            if self._pool is not None:
+                self._pool.discard()
+
+        if failed:
+            logger.warning(f"{len(failed)} media of {unit.id} failed to chunk, the unit stays unfinished")
+            complete = False
+
+        # the uploaded db must contain every chunk of the shards
+        uow.commit()
+        writer.close()
+        uow.before_commit.remove(writer.flush)
+
+        if not complete:
+            return False, None
+
+        if writer.count == 0:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            return True, None
+
+        # snapshot the committed db, the live one keeps changing meanwhile
+        shutil.copy('data.db', join(upload_dir, self.db_name))
+        return True, upload_dir
+
+    def _process_media(self, uow: UnitOfWork, writer: ShardWriter, unit: Unit, item: Media) -> None:
+        logger.info(f"Processing {self.adapter.name} ID: {item.id}")
+
+        captions = self.adapter.get_captions(item)
+        if not captions:
+            logger.warning(f"No captions extracted from {item.sub_path}.")
+            self._record(uow, writer, unit, item, [])
+            return
+
+        # samples reach the shards only once the whole media is chunked, a
+        # media failing half way leaves neither samples nor rows behind
+        buffer = SampleBuffer()
+        processed_captions = self.chunker.chunk(
+            merge=self.adapter.merge,
+            audio_file=item.audio_path,
+            captions=captions,
+            writer=buffer,
+            encode_statuses=self.encode_statuses
+        )
+        buffer.replay(writer)
+        self._record(uow, writer, unit, item, processed_captions)
+
+    def _record(self, uow: UnitOfWork, writer: ShardWriter, unit: Unit, item: Media,
+                processed_captions: List[Caption]) -> None:
+        logger.info(f"Created {len(processed_captions)} audio chunks for {item.id}")
+
+        # media without chunks are recorded too, so a resumed unit skips them
+        uow.add_chunks(self.adapter.name, item.id, processed_captions, unit.id)
+        logger.info(f"Recorded processed chunks in the database for {item.id}")
+
+        if writer.full:
+            uow.commit()
+
+    def _cleanup(self, item: Media) -> None:
+        # streamed media are only on disk until they are chunked
+        if self.stream:
+            remove(item.audio_path)
+            remove(item.sub_path)
+
+    def _upload(self, unit: Unit, upload_dir: str) -> None:
+        # the lease may have expired since the last heartbeat; the shards
+        # stay on disk in case the unit comes back to this node
+        if self.queue is not None and not self.queue.renew(unit.id):
+            self._lose(unit.id)
+            logger.warning(f"Not uploading {unit.id}, its lease was lost")
+            return
+
+        # shards and db land in the target repo in a single commit
+        hub_retry(self.hub.upload_folder)(
+            repo_id=self.adapter.target_repo_id,
+            folder_path=upload_dir,
+            repo_type='dataset'
+        )
+        logger.info(f"Uploaded shards and db of {unit.id}")
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        self._finish(unit, True)
+
+    def _claim(self, unit: Unit) -> bool:
+        if self.queue is None:
+            return True
+        if not self.queue.claim(unit.id):
+            logger.info(f"{unit.id} is leased or completed by another node. Skipping.")
+            return False
+        self._held.add(unit.id)
+        self._lost.discard(unit.id)
+        return True
+
+    def _finish(self, unit: Unit, done: bool) -> None:
+        """
+        Completes the unit in the work queue, or gives it back if not done.
+        """
+        if self.queue is None:
+            return
+        self._held.discard(unit.id)
+        if not done:
+            self.queue.release(unit.id)
+        elif not self.queue.complete(unit.id):
+            logger.warning(f"Could not complete {unit.id}, its lease was lost")
+
+    def _lose(self, unit_id: str) -> None:
+        self._held.discard(unit_id)
+        self._lost.add(unit_id)
+
+    def _heartbeat(self, stop: Event) -> None:
+        # renew often enough that a lease survives a couple of missed beats
+        while not stop.wait(self.queue.lease_seconds / 3):
+            for unit_id in list(self._held):
+                if not self.queue.renew(unit_id):
+                    logger.warning(f"Lost the lease of {unit_id}")
+                    self._lose(unit_id)
+
+    def run(self) -> None:
+        self._prepare_db()
+
+        units = self.adapter.list_units(self.hub)
+        logger.info(f"Found {len(units)} units in repository {self.adapter.repo_id}.")
+
+        makedirs(self.tmp_dir, exist_ok=True)
+        makedirs(self.uploads_dir, exist_ok=True)
+
+        if self.workers > 1:
+            self._pool = ChunkingPool(self.workers, **self.chunker_options)
+
+        stop_heartbeat = Event()
+        if self.queue is not None:
+            Thread(target=self._heartbeat, args=(stop_heartbeat,), daemon=True).start()
+
+        try:
+            self._run(units)
+        finally:
+            stop_heartbeat.set()
+            # leases still held belong to units this run did not finish
+            for unit_id in list(self._held):
+                self.queue.release(unit_id)
+            self._held.clear()
+
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def _run(self, units: List[Unit]) -> None:
+        pending = iter(units)
+        fetched = deque()
+        upload = None
+
+        with UnitOfWork() as uow, ThreadPoolExecutor(1) as downloads, ThreadPoolExecutor(1) as uploads:
+            def prefetch():
+                while len(fetched) < max(self.prefetch, 1):
+                    if fetched and disk_usage(self.tmp_dir, self.uploads_dir) >= self.max_disk_bytes:
+                        logger.info("Disk limit reached, not prefetching")
+                        return
+                    unit = next(pending, None)
+                    if unit is None:
+                        return
+                    if not self._claim(unit):
+                        continue
+                    unit = self.adapter.remaining(unit, uow)
+                    # a unit chunked completely may still have shards to upload
+                    if not unit.files and not isdir(join(self.uploads_dir, unit.id)):
+                        logger.info(f"{unit.id} already processed. Skipping.")
+                        self._finish(unit, True)
+                        continue
+                    fetched.append((unit, downloads.submit(self._fetch, unit)))
+
+            prefetch()
+            while fetched:
+                unit, future = fetched.popleft()
+                try:
+                    media = future.result()
+                except Exception as e:
+                    logger.error(f"Error fetching {unit.id}: {e}")
+                    shutil.rmtree(join(self.tmp_dir, unit.id), ignore_errors=True)
+                    self._finish(unit, False)
+                    prefetch()
+                    continue
+                prefetch()
+
+                if media is None:
+                    logger.info(f'Already uploaded {unit.id}. Skipping.')
+                    self._finish(unit, True)
+                    continue
+
+                complete, upload_dir = self._process(uow, unit, media)
+                shutil.rmtree(join(self.tmp_dir, unit.id), ignore_errors=True)
+
+                if upload_dir is None:
+                    if complete:
+                        logger.warning(f"No chunks created for {unit.id}. Skipping.")
+                    self._finish(unit, complete)
+                    continue
+
+                if upload is not None:
+                    upload.result()
+                upload = uploads.submit(self._upload, unit, upload_dir)
+
+            if upload is not None:
+                upload.result()
+
+
+def main(adapter: SourceAdapter) -> None:
+    """
+    Command line entry point shared by the source drivers.
+    """
+    parser = argparse.ArgumentParser(description=f'Chunk {adapter.name} into {adapter.target_repo_id}')
+    parser.add_argument('--hub-dir', help='local directory standing in for the hub, for testing')
+    parser.add_argument('--prefetch', type=int, default=1,
+                        help='number of units downloaded ahead of the one being chunked')
+    parser.add_argument('--max-disk-gb', type=float, default=50.0,
+                        help='no unit is prefetched while downloads and uploads use more than this')
+    parser.add_argument('--stream', action='store_true',
+                        help='chunk media straight from the archive download stream')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes chunking the media of a unit in parallel')
+    parser.add_argument('--encode-status', nargs='+', choices=[s.name for s in ValidationStatus],
+                        help='only chunks with these statuses get audio, the others are recorded without')
+    parser.add_argument('--refine-window', type=float, default=0.0,
+                        help='move chunk boundaries by up to this many seconds to the nearest quiet point')
+    parser.add_argument('--classify', action='store_true',
+                        help='label chunks with a music bed DIALOGUE and do not encode them')
+    parser.add_argument('--overlap-model', action='store_true',
+                        help='with --classify, also leave out overlapped speech found by the segmentation model')
+    parser.add_argument('--queue-db', help='SQLite work queue shared by all nodes')
+    parser.add_argument('--queue-dir', help='directory work queue, for testing on one machine')
+    parser.add_argument('--node', default=socket.gethostname(), help='name of this node in the work queue')
+    parser.add_argument('--listing-ttl', type=float, default=3600.0,
+                        help='seconds repo file listings are cached for, also between runs')
+    parser.add_argument('--blob-cache-dir',
+                        help='keep downloaded source files in this directory for later runs')
+    parser.add_argument('--blob-cache-gb', type=float, default=100.0,
+                        help='least recently used source files are evicted beyond this size')
+    parser.add_argument('--lease-seconds', type=float, default=600.0,
+                        help='time after which units of a silent node are handed out again')
+    args = parser.parse_args()
+
+    queue = None
+    if args.queue_db:
+        queue = SQLiteWorkQueue(args.queue_db, args.node, args.lease_seconds)
+    elif args.queue_dir:
+        queue = DirectoryWorkQueue(args.queue_dir, args.node, args.lease_seconds)
+
+    encode_statuses = {ValidationStatus[s] for s in args.encode_status} if args.encode_status else None
+
+    hub = get_hub(args.hub_dir, args.listing_ttl, blob_dir=args.blob_cache_dir, blob_gb=args.blob_cache_gb)
+    Runner(adapter, hub, args.prefetch, args.max_disk_gb,
+           stream=args.stream, workers=args.workers, queue=queue,
+           encode_statuses=encode_statuses, refine_window=args.refine_window,
+           classify=args.classify, overlap_model=args.overlap_model).run()
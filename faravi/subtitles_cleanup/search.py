@@ -0,0 +1,82 @@
+import argparse
+from typing import Optional
+from sqlalchemy import text, column
+from sqlalchemy.orm import Session
+
+from db import AudioChunk, init_db, get_db_session
+from normalizer import ValidationStatus
+
+
+def _filter(query, status: Optional[ValidationStatus], min_duration: Optional[float],
+            max_duration: Optional[float], source: Optional[str]):
+    if status is not None:
+        query = query.filter(AudioChunk.invalidation == status)
+    if min_duration is not None:
+        query = query.filter(AudioChunk.duration >= min_duration)
+    if max_duration is not None:
+        query = query.filter(AudioChunk.duration <= max_duration)
+    if source is not None:
+        query = query.filter(AudioChunk.source == source)
+    return query
+
+def search_text(session: Session, query: str, phrase: bool = False,
+                status: Optional[ValidationStatus] = None,
+                min_duration: Optional[float] = None,
+                max_duration: Optional[float] = None,
+                source: Optional[str] = None,
+                limit: Optional[int] = 100) -> list[AudioChunk]:
+    """
+    Returns chunks whose transcript matches the FTS5 query, optionally
+    narrowed down by status, duration range and source. If phrase is True
+    the query is matched as one exact phrase instead of FTS5 syntax.
+    """
+    if phrase:
+        query = '"' + query.replace('"', '""') + '"'
+
+    matches = (
+        text('SELECT rowid FROM audio_chunks_fts WHERE audio_chunks_fts MATCH :query')
+        .bindparams(query=query)
+        .columns(column('rowid'))
+    )
+
+    result = session.query(AudioChunk).filter(AudioChunk.id.in_(matches))
+    result = _filter(result, status, min_duration, max_duration, source)
+    return result.order_by(AudioChunk.id).limit(limit).all()
+
+def chunks_by_duration(session: Session, min_duration: Optional[float] = None,
+                       max_duration: Optional[float] = None,
+                       status: Optional[ValidationStatus] = ValidationStatus.VALID,
+                       source: Optional[str] = None,
+                       limit: Optional[int] = 100) -> list[AudioChunk]:
+    """
+    Returns chunks whose duration lies in [min_duration, max_duration],
+    using the index on the stored duration column.
+    """
+    query = _filter(session.query(AudioChunk), status, min_duration, max_duration, source)
+    return query.order_by(AudioChunk.duration).limit(limit).all()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search chunk transcripts and durations')
+    parser.add_argument('query', nargs='?', help='FTS5 query over the transcripts')
+    parser.add_argument('--phrase', action='store_true', help='match the query as one exact phrase')
+    parser.add_argument('--min', type=float, dest='min_duration', help='minimum duration in seconds')
+    parser.add_argument('--max', type=float, dest='max_duration', help='maximum duration in seconds')
+    parser.add_argument('--source', help='restrict results to one source, e.g. youtube')
+    parser.add_argument('--status', default='VALID', choices=[s.name for s in ValidationStatus] + ['ALL'])
+    parser.add_argument('--limit', type=int, default=100)
+    args = parser.parse_args()
+
+    status = None if args.status == 'ALL' else ValidationStatus[args.status]
+
+    init_db()
+    with get_db_session() as session:
+        if args.query:
+            chunks = search_text(session, args.query, args.phrase, status,
+                                 args.min_duration, args.max_duration, args.source, args.limit)
+        else:
+            chunks = chunks_by_duration(session, args.min_duration, args.max_duration,
+                                        status, args.source, args.limit)
+
+        for chunk in chunks:
+            print(f"{chunk.source}/{chunk.source_id}/{chunk.audio}\t{chunk.duration:.2f}s\t{chunk.text}")
@@ -0,0 +1,91 @@
+import os
+import time
+from typing import List, Optional
+from huggingface_hub import get_token, login
+from chunker import Caption
+from utils import SingletonLogger
+
+logger = SingletonLogger().get_logger()
+
+# Hub id of the segmentation model, or a local checkpoint path
+DEFAULT_CHECKPOINT = os.environ.get('VAD_CHECKPOINT', 'pyannote/segmentation-3.0')
+
+HYPER_PARAMETERS = {
+    "min_duration_on": 0.0,
+    "min_duration_off": 0.0
+}
+
+
+class SegmentationPipeline:
+    """
+    A pyannote pipeline on top of the segmentation model. The model is only
+    loaded on first use and then serves every following file, so a process
+    pays for loading it once; an unloaded pipeline can be sent to worker
+    processes, which each load their own. Nothing is loaded at import time.
+    """
+
+    def __init__(self, checkpoint: str = DEFAULT_CHECKPOINT, hyper_parameters: Optional[dict] = None,
+                 device: Optional[str] = None):
+        self.checkpoint = checkpoint
+        self.hyper_parameters = hyper_parameters or HYPER_PARAMETERS
+        self.device = device
+        self._pipeline = None
+
+    def __getstate__(self):
+        # a loaded model is never pickled, the receiving process loads its own
+        return {**self.__dict__, '_pipeline': None}
+
+    def _pipeline_class(self):
+        raise NotImplementedError
+
+    def _load(self):
+        # pyannote is heavy to import, only processes running the model need it
+        from pyannote.audio import Model
+
+        # the gated model needs a token, local checkpoints do not
+        if not os.path.exists(self.checkpoint) and get_token() is None:
+            login()
+
+        s = time.time()
+        model = Model.from_pretrained(self.checkpoint)
+        pipeline = self._pipeline_class()(segmentation=model)
+        pipeline.instantiate(self.hyper_parameters)
+        if self.device:
+            import torch
+            pipeline.to(torch.device(self.device))
+        logger.info(f"Loaded {type(self).__name__} model {self.checkpoint} in {time.time() - s:.1f}s")
+        return pipeline
+
+    @property
+    def pipeline(self):
+        if self._pipeline is None:
+            self._pipeline = self._load()
+        return self._pipeline
+
+    def __call__(self, audio):
+        """
+        Runs the pipeline on a file path or on an already decoded AudioBuffer.
+        """
+        if hasattr(audio, 'samples'):
+            import torch
+            # a view of the buffer, the samples are not copied
+            audio = {'waveform': torch.from_numpy(audio.samples).unsqueeze(0), 'sample_rate': audio.sample_rate}
+        return self.pipeline(audio)
+
+
+class OverlapDetector(SegmentationPipeline):
+    """
+    Overlapped speech detection, the overlap callable of an
+    AcousticClassifier. Buffers of any rate are accepted and resampled to
+    the 16 kHz of the model, e.g. the 8 kHz analysis decode of the chunker.
+    """
+
+    def _pipeline_class(self):
+        from pyannote.audio.pipelines import OverlappedSpeechDetection
+        return OverlappedSpeechDetection
+
+    def overlaps(self, audio) -> List[Caption]:
+        """
+        Returns the regions where more than one speaker talks.
+        """
+        return [Caption(segment.start, segment.end, '') for segment, _ in self(audio).itertracks()]
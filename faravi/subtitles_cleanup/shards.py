@@ -0,0 +1,170 @@
+import io
+import json
+import os
+import tarfile
+import time
+from typing import Optional
+from utils import SingletonLogger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = SingletonLogger().get_logger()
+
+INDEX_FILE = 'index.json'
+
+
+class ShardWriter:
+    """
+    Streams samples into size bounded, WebDataset style tar shards. Every
+    sample is a set of files sharing one key, e.g. {key}.mp3 and {key}.json.
+
+    A shard is written as {name}.part and only renamed and added to
+    index.json once it is complete, so after a crash the writer can be
+    reopened on the same directory: complete shards are kept and the
+    partial one is discarded. Shards are never completed mid sample group;
+    callers flush once full is set, at a point where everything written is
+    also committed to the database.
+    """
+
+    def __init__(self, output_dir: str, prefix: str, max_shard_size: int = 1 << 30,
+                 compression: Optional[str] = None):
+        if compression not in (None, 'zstd'):
+            raise ValueError(f"Unsupported shard compression: {compression}")
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError("zstd shards require the zstandard package")
+
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.max_shard_size = max_shard_size
+        self.compression = compression
+
+        self._tar: Optional[tarfile.TarFile] = None
+        self._file = None
+        self._stream = None
+        self._shard_name: Optional[str] = None
+        self._shard_size = 0
+        self._shard_keys: list[str] = []
+
+        os.makedirs(output_dir, exist_ok=True)
+        self.shards = self._load_index()
+
+    @property
+    def count(self) -> int:
+        """
+        Number of samples written, including those of resumed shards.
+        """
+        return sum(shard['count'] for shard in self.shards) + len(self._shard_keys)
+
+    @property
+    def full(self) -> bool:
+        return self._shard_size >= self.max_shard_size
+
+    def _load_index(self) -> list[dict]:
+        for name in os.listdir(self.output_dir):
+            if name.endswith('.part'):
+                logger.warning(f"Discarding incomplete shard {name}")
+                os.remove(os.path.join(self.output_dir, name))
+
+        index_path = os.path.join(self.output_dir, INDEX_FILE)
+        if not os.path.isfile(index_path):
+            return []
+        with open(index_path, 'r') as f:
+            return json.load(f)['shards']
+
+    def _save_index(self) -> None:
+        index_path = os.path.join(self.output_dir, INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump({'prefix': self.prefix, 'shards': self.shards}, f, ensure_ascii=False)
+        os.replace(index_path + '.tmp', index_path)
+
+    def _open_shard(self) -> None:
+        extension = '.tar.zst' if self.compression == 'zstd' else '.tar'
+        self._shard_name = f'{self.prefix}-{len(self.shards):06d}{extension}'
+        self._file = open(os.path.join(self.output_dir, self._shard_name + '.part'), 'wb')
+
+        self._stream = self._file
+        if self.compression == 'zstd':
+            self._stream = zstandard.ZstdCompressor().stream_writer(self._file, closefd=False)
+
+        self._tar = tarfile.open(fileobj=self._stream, mode='w|')
+        self._shard_size = 0
+        self._shard_keys = []
+
+    def write(self, key: str, files: dict[str, bytes]) -> None:
+        """
+        Appends one sample; files maps extensions (without dot) to contents.
+        """
+        if self._tar is None:
+            self._open_shard()
+
+        mtime = time.time()
+        for extension, data in files.items():
+            info = tarfile.TarInfo(f'{key}.{extension}')
+            info.size = len(data)
+            info.mtime = mtime
+            self._tar.addfile(info, io.BytesIO(data))
+            self._shard_size += len(data)
+
+        self._shard_keys.append(key)
+
+    def flush(self) -> None:
+        """
+        Completes the current shard, so every sample written so far is in a
+        finished shard listed in the index.
+        """
+        if self._tar is None:
+            return
+
+        self._tar.close()
+        if self._stream is not self._file:
+            self._stream.close()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+        path = os.path.join(self.output_dir, self._shard_name)
+        os.replace(path + '.part', path)
+
+        self.shards.append({
+            'name': self._shard_name,
+            'size': os.path.getsize(path),
+            'count': len(self._shard_keys),
+            'keys': self._shard_keys
+        })
+        self._save_index()
+        logger.info(f"Wrote shard {path} with {len(self._shard_keys)} samples")
+
+        self._tar = self._file = self._stream = self._shard_name = None
+        self._shard_size = 0
+        self._shard_keys = []
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self) -> 'ShardWriter':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        # On error leave the partial shard behind, it is dropped on reopen
+        if exc_type is None:
+            self.close()
+
+
+class SampleBuffer:
+    """
+    Collects samples in memory with the ShardWriter.write interface, e.g. in
+    a worker process whose samples are written to the shards by the parent.
+    """
+
+    def __init__(self):
+        self.samples: list[tuple[str, dict[str, bytes]]] = []
+
+    def write(self, key: str, files: dict[str, bytes]) -> None:
+        self.samples.append((key, files))
+
+    def replay(self, writer: ShardWriter) -> None:
+        for key, files in self.samples:
+            writer.write(key, files)
@@ -0,0 +1,142 @@
+import os
+import tarfile
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Callable, Collection, Iterator, List, Union
+from tenacity import retry, stop_after_attempt, wait_exponential
+
+from chunker import Caption
+from db import UnitOfWork
+from hub import open_file
+from utils import SingletonLogger
+
+logger = SingletonLogger().get_logger()
+
+# Shared retry policy for hub transfers
+hub_retry = retry(stop=stop_after_attempt(5), wait=wait_exponential(multiplier=1, min=4, max=600), reraise=True)
+
+
+@dataclass
+class Media:
+    """
+    One audio file with its subtitles, chunked and recorded under its id.
+    """
+    id: str
+    audio_path: str
+    sub_path: str
+
+
+@dataclass
+class Unit:
+    """
+    A group of media fetched, sharded and uploaded together, e.g. a youtube
+    channel, a ganjoor artist or a batch of movies.
+    """
+    id: str
+    files: List[str] = field(default_factory=list)
+
+
+class SourceAdapter(ABC):
+    """
+    Everything that differs between sources: which units exist, how to fetch
+    one and find its media, and how to parse captions. The runner does the
+    rest, the same way for every source.
+    """
+    name: str               # source column in the database
+    repo_id: str            # hub repo the raw data is read from
+    target_repo_id: str     # hub repo the shards and db are uploaded to
+    merge: bool = True      # whether consecutive captions get merged
+
+    @abstractmethod
+    def list_units(self, hub) -> List[Unit]:
+        """
+        Returns all units of the source repo, in processing order.
+        """
+
+    @abstractmethod
+    def fetch(self, hub, unit: Unit, work_dir: str) -> List[Media]:
+        """
+        Downloads the unit into work_dir and returns its media.
+        """
+
+    @abstractmethod
+    def get_captions(self, media: Media) -> List[Caption]:
+        """
+        Parses the subtitles of the media, returns [] if they are unusable.
+        """
+
+    def stream(self, hub, unit: Unit, work_dir: str) -> Iterator[Media]:
+        """
+        Like fetch, but yields each media as soon as its files are on disk.
+        Sources that cannot stream fall back to fetching the whole unit.
+        """
+        yield from self.fetch(hub, unit, work_dir)
+
+    def is_uploaded(self, unit: Unit, target_files: Collection[str]) -> bool:
+        """
+        Whether the unit's shards are already in the target repo.
+        """
+        return f'{unit.id}/index.json' in target_files
+
+    def remaining(self, unit: Unit, uow: UnitOfWork) -> Unit:
+        """
+        The part of the unit still to be processed according to the
+        database, for units whose files can be fetched one by one. A unit
+        without files left is skipped, unless its shards are still waiting
+        in the uploads directory.
+        """
+        return unit
+
+    def download_file(self, hub, filename: str, local_dir: str) -> str:
+        return hub_retry(hub.hf_hub_download)(
+            self.repo_id, filename, repo_type='dataset', local_dir=local_dir
+        )
+
+    def download_snapshot(self, hub, allow_patterns: Union[str, List[str]], local_dir: str) -> str:
+        return hub_retry(hub.snapshot_download)(
+            self.repo_id, repo_type='dataset', local_dir=local_dir, allow_patterns=allow_patterns
+        )
+
+
+def stream_tar_pairs(fileobjs, work_dir: str, audio_ext: str, sub_ext: str,
+                     key: Callable[[str], str]) -> Iterator[tuple[str, str]]:
+    """
+    Reads .tar.gz streams member by member and extracts only audio and
+    subtitle files, yielding (audio_path, sub_path) as soon as both files
+    with the same key have arrived. Nothing else of the archives is kept.
+    """
+    waiting: dict[str, dict[str, str]] = {}
+
+    for fileobj in fileobjs:
+        with fileobj, tarfile.open(fileobj=fileobj, mode='r|gz') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                if member.name.endswith(audio_ext):
+                    kind = 'audio'
+                elif member.name.endswith(sub_ext):
+                    kind = 'sub'
+                else:
+                    continue
+
+                tar.extract(member, work_dir)
+                pair = waiting.setdefault(key(member.name), {})
+                pair[kind] = os.path.join(work_dir, member.name)
+
+                if len(pair) == 2:
+                    del waiting[key(member.name)]
+                    yield pair['audio'], pair['sub']
+
+    for name, pair in waiting.items():
+        logger.error(f"Missing subtitles or audio file for {name}")
+        for path in pair.values():
+            os.remove(path)
+
+
+def open_tar_files(hub, repo_id: str, tar_files: List[str]):
+    """
+    Lazily opens the given repo files as network streams, one at a time.
+    """
+    for tar_file in tar_files:
+        logger.info(f"Streaming {tar_file}")
+        yield open_file(hub, repo_id, tar_file)
@@ -0,0 +1,89 @@
+import argparse
+from typing import Optional
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from db import ChunkStats, init_db, get_db_session, rebuild_stats
+from normalizer import ValidationStatus
+
+
+def seconds_by_source(session: Session,
+                      status: Optional[ValidationStatus] = ValidationStatus.VALID) -> dict[str, tuple[int, float]]:
+    """
+    Returns {source: (count, seconds)} for chunks with the given status,
+    or for all chunks if status is None.
+    """
+    query = session.query(
+        ChunkStats.source,
+        func.sum(ChunkStats.count),
+        func.sum(ChunkStats.seconds)
+    )
+    if status is not None:
+        query = query.filter(ChunkStats.invalidation == status)
+
+    return {source: (count, seconds) for source, count, seconds in query.group_by(ChunkStats.source)}
+
+def seconds_by_source_id(session: Session, source: str,
+                         status: Optional[ValidationStatus] = ValidationStatus.VALID) -> dict[str, tuple[int, float]]:
+    """
+    Returns {source_id: (count, seconds)} within a source for chunks with the
+    given status, or for all chunks if status is None.
+    """
+    query = session.query(
+        ChunkStats.source_id,
+        func.sum(ChunkStats.count),
+        func.sum(ChunkStats.seconds)
+    ).filter(ChunkStats.source == source)
+    if status is not None:
+        query = query.filter(ChunkStats.invalidation == status)
+
+    return {source_id: (count, seconds) for source_id, count, seconds in query.group_by(ChunkStats.source_id)}
+
+def status_distribution(session: Session, source: Optional[str] = None,
+                        source_id: Optional[str] = None) -> dict[ValidationStatus, tuple[int, float]]:
+    """
+    Returns {status: (count, seconds)}, optionally restricted to a source
+    and/or a single source_id.
+    """
+    query = session.query(
+        ChunkStats.invalidation,
+        func.sum(ChunkStats.count),
+        func.sum(ChunkStats.seconds)
+    )
+    if source is not None:
+        query = query.filter(ChunkStats.source == source)
+    if source_id is not None:
+        query = query.filter(ChunkStats.source_id == source_id)
+
+    return {status: (count, seconds) for status, count, seconds in query.group_by(ChunkStats.invalidation)}
+
+
+def _print_table(title: str, rows: dict, limit: Optional[int] = None) -> None:
+    print(title)
+    items = sorted(rows.items(), key=lambda item: item[1][1], reverse=True)
+    for key, (count, seconds) in items[:limit]:
+        name = key.name if isinstance(key, ValidationStatus) else key
+        print(f"  {name:<40} {count:>10} chunks {seconds / 3600:>10.2f} h")
+    print()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report chunk counts and hours from the summary table')
+    parser.add_argument('--source', help='restrict the report to one source, e.g. youtube')
+    parser.add_argument('--status', default='VALID', choices=[s.name for s in ValidationStatus] + ['ALL'])
+    parser.add_argument('--top', type=int, default=20, help='number of source ids to list')
+    parser.add_argument('--rebuild', action='store_true', help='recompute the summary table from audio_chunks')
+    args = parser.parse_args()
+
+    status = None if args.status == 'ALL' else ValidationStatus[args.status]
+
+    init_db()
+    with get_db_session() as session:
+        if args.rebuild:
+            rebuild_stats(session)
+
+        _print_table('Status distribution', status_distribution(session, args.source))
+        if args.source:
+            _print_table(f'{args.source} by source id ({args.status})',
+                         seconds_by_source_id(session, args.source, status), args.top)
+        else:
+            _print_table(f'By source ({args.status})', seconds_by_source(session, status))
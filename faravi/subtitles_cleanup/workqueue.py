@@ -0,0 +1,211 @@
+import json
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from uuid import uuid4
+from utils import SingletonLogger
+
+logger = SingletonLogger().get_logger()
+
+
+def run_token() -> str:
+    """
+    A token unique to this process: two processes never share one, even on
+    the same host.
+    """
+    return f"{os.getpid()}-{uuid4().hex[:8]}"
+
+
+class WorkQueue(ABC):
+    """
+    Lease based coordination of units between nodes. A node claims a unit
+    for lease_seconds and keeps renewing the lease while working on it; if
+    the node crashes the lease expires and another node can claim the unit.
+    Completed units are never handed out again.
+
+    Node names are stable across runs, e.g. the hostname. Every lease also
+    records the run token of the queue object holding it, so a lease held
+    under the same node name by another process, e.g. a second runner on
+    the same host or a run that crashed, is never taken over before it
+    expires.
+    """
+
+    def __init__(self, node: str, lease_seconds: float = 600.0):
+        self.node = node
+        self.run = run_token()
+        self.lease_seconds = lease_seconds
+
+    @abstractmethod
+    def claim(self, unit_id: str) -> bool:
+        """
+        Claims the unit if it is neither completed nor leased by another
+        node. Returns whether this node now holds the lease.
+        """
+
+    @abstractmethod
+    def renew(self, unit_id: str) -> bool:
+        """
+        Extends this node's lease. Returns False if the lease was lost.
+        """
+
+    @abstractmethod
+    def complete(self, unit_id: str) -> bool:
+        """
+        Atomically marks the unit as done and drops the lease, if this node
+        still holds it. Returns False if the lease was lost.
+        """
+
+    @abstractmethod
+    def release(self, unit_id: str) -> None:
+        """
+        Drops this node's lease without completing the unit.
+        """
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """
+    Work queue in a SQLite file shared by all nodes. Claims run in
+    IMMEDIATE transactions, so two nodes can never hold the same unit.
+    """
+
+    def __init__(self, path: str, node: str, lease_seconds: float = 600.0):
+        super().__init__(node, lease_seconds)
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    unit_id TEXT PRIMARY KEY,
+                    node TEXT,
+                    expires REAL,
+                    done INTEGER NOT NULL DEFAULT 0,
+                    run TEXT
+                )
+            """)
+            # queues created before leases recorded their run
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(leases)')]
+            if 'run' not in columns:
+                conn.execute('ALTER TABLE leases ADD COLUMN run TEXT')
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def _transaction(self, statement: str, params: tuple) -> int:
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            count = conn.execute(statement, params).rowcount
+            conn.execute('COMMIT')
+            return count
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def claim(self, unit_id: str) -> bool:
+        now = time.time()
+        return self._transaction("""
+            INSERT INTO leases (unit_id, node, run, expires) VALUES (?, ?, ?, ?)
+            ON CONFLICT (unit_id) DO UPDATE SET node = excluded.node, run = excluded.run, expires = excluded.expires
+            WHERE leases.done = 0 AND (leases.expires < ? OR (leases.node = excluded.node AND leases.run = excluded.run))
+        """, (unit_id, self.node, self.run, now + self.lease_seconds, now)) == 1
+
+    def renew(self, unit_id: str) -> bool:
+        return self._transaction(
+            'UPDATE leases SET expires = ? WHERE unit_id = ? AND node = ? AND run = ? AND done = 0',
+            (time.time() + self.lease_seconds, unit_id, self.node, self.run)
+        ) == 1
+
+    def complete(self, unit_id: str) -> bool:
+        return self._transaction(
+            'UPDATE leases SET done = 1, expires = NULL WHERE unit_id = ? AND node = ? AND run = ? AND done = 0',
+            (unit_id, self.node, self.run)
+        ) == 1
+
+    def release(self, unit_id: str) -> None:
+        self._transaction(
+            'UPDATE leases SET expires = 0 WHERE unit_id = ? AND node = ? AND run = ? AND done = 0',
+            (unit_id, self.node, self.run)
+        )
+
+
+class DirectoryWorkQueue(WorkQueue):
+    """
+    Work queue as files in a local directory, for tests and single machine
+    runs. A lease is {unit}.lease, created exclusively by hard linking a
+    fully written file; completion is the atomic rename of {unit}.done into
+    place.
+    """
+
+    def __init__(self, path: str, node: str, lease_seconds: float = 600.0):
+        super().__init__(node, lease_seconds)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _lease_path(self, unit_id: str) -> str:
+        return os.path.join(self.path, unit_id + '.lease')
+
+    def _done_path(self, unit_id: str) -> str:
+        return os.path.join(self.path, unit_id + '.done')
+
+    def _read_lease(self, unit_id: str) -> dict:
+        try:
+            with open(self._lease_path(unit_id), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _owns(self, lease: dict) -> bool:
+        return lease.get('node') == self.node and lease.get('run') == self.run
+
+    def _write_tmp_lease(self, unit_id: str) -> str:
+        # leases are written aside first, so readers never see a partial one
+        tmp_path = f'{self._lease_path(unit_id)}.{self.node}.{self.run}'
+        with open(tmp_path, 'w') as f:
+            json.dump({'node': self.node, 'run': self.run, 'expires': time.time() + self.lease_seconds}, f)
+        return tmp_path
+
+    def claim(self, unit_id: str) -> bool:
+        if os.path.exists(self._done_path(unit_id)):
+            return False
+
+        tmp_path = self._write_tmp_lease(unit_id)
+        try:
+            os.link(tmp_path, self._lease_path(unit_id))
+            return True
+        except FileExistsError:
+            lease = self._read_lease(unit_id)
+            if lease and not self._owns(lease) and lease['expires'] >= time.time():
+                return False
+            if not self._owns(lease):
+                logger.info(f"Taking over expired lease of {unit_id}")
+            os.replace(tmp_path, self._lease_path(unit_id))
+            # two nodes taking over the same expired lease: the last rename wins
+            return self._owns(self._read_lease(unit_id))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def renew(self, unit_id: str) -> bool:
+        if not self._owns(self._read_lease(unit_id)):
+            return False
+        os.replace(self._write_tmp_lease(unit_id), self._lease_path(unit_id))
+        return True
+
+    def complete(self, unit_id: str) -> bool:
+        if not self._owns(self._read_lease(unit_id)):
+            return False
+        tmp_path = f'{self._done_path(unit_id)}.{self.node}.{self.run}'
+        with open(tmp_path, 'w') as f:
+            json.dump({'node': self.node, 'completed': time.time()}, f)
+        os.replace(tmp_path, self._done_path(unit_id))
+        self.release(unit_id)
+        return True
+
+    def release(self, unit_id: str) -> None:
+        if self._owns(self._read_lease(unit_id)):
+            try:
+                os.remove(self._lease_path(unit_id))
+            except FileNotFoundError:
+                pass
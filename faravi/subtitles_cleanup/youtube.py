@@ -1,133 +1,59 @@
 import tarfile
-import shutil
-from huggingface_hub import HfApi
-import webvtt
-from os.path import join, basename, isdir, relpath
-from os import makedirs, listdir, remove
+from os.path import join, basename, dirname
+from os import listdir, remove
 from itertools import groupby
-from tenacity import retry, stop_after_attempt, wait_exponential
 
-from chunker import AudioChunker, Caption
-from db import create_chunks, init_db, get_db_session, chunk_exists
+from captions import read_subtitles
+from sources import SourceAdapter, Unit, Media, stream_tar_pairs, open_tar_files
+from runner import main
 from utils import SingletonLogger
 
 logger = SingletonLogger().get_logger()
 
-hf_api = HfApi()
-repo_id = 'farsi-asr/farsi-asr-dataset'
-target_repo_id = 'farsi-asr/farsi-youtube-asr-dataset'
-tmp_dir = 'tmp'
-
-def get_captions(sub_path):
-    def format_time(t):
-        return t.hours * 3600 + t.minutes * 60 + t.seconds + t.milliseconds / 1000
-    
-    try:
-        sub = webvtt.read(sub_path)
-    except Exception as e:
-        logger.error(f"Error reading subtitles from {sub_path}: {e}")
-        return []
-
-    captions = []
-    for caption in sub.iter_slice():
-        start_time = format_time(caption.start_time)
-        end_time = format_time(caption.end_time)
-        captions.append(
-            Caption(
-                start=start_time,
-                end=end_time,
-                text=caption.text.strip()
-            )
-        )
-
-    return captions
 
 def get_channel_id(tar_file):
     return basename(tar_file)[:24]
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def _download_tar_file(tar_file):
-    return hf_api.hf_hub_download(
-        repo_id, tar_file, repo_type='dataset', local_dir=tmp_dir
-    )
-
-def download_and_extract_tar_file(tar_files):
-    channel_id = get_channel_id(tar_files[0])
-
-    if f'{channel_id}.tar.gz' in hf_api.list_repo_files(target_repo_id, repo_type='dataset'):
-        return None
-
-    for tar_file in tar_files:
-        try:
-            tar_path = _download_tar_file(tar_file)
-            logger.info(f"Downloaded {tar_file}")
-        except Exception as e:
-            logger.error(f"Error downloading {tar_file}: {e}")
-            shutil.rmtree(tmp_dir, ignore_errors=True)
-        
-        try:
-            with tarfile.open(tar_path, 'r:gz') as tar:
-                tar.extractall(tmp_dir)
-            logger.info(f"Extracted {tar_file} into {tmp_dir}")
-        except Exception as e:
-            logger.error(f"Error extracting {tar_file}: {e}")
-            shutil.rmtree(tmp_dir, ignore_errors=True)
-            continue
-
-    return channel_id
-
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def upload_archive(archive_path):
-    hf_api.upload_file(
-        path_or_fileobj=archive_path,
-        path_in_repo=basename(archive_path),
-        repo_id=target_repo_id,
-        repo_type='dataset'
-    )
-    logger.info(f"Uploaded archive {archive_path}")
-
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def upload_db():
-    hf_api.upload_file(
-        path_or_fileobj='data.db',
-        path_in_repo='data.db',
-        repo_id=target_repo_id,
-        repo_type='dataset'
-    )
-    logger.info("Uploaded database")
 
-if __name__ == '__main__':
-    # check if db exists in target repo
-    if 'data.db' not in hf_api.list_repo_files(target_repo_id, repo_type='dataset'):
-        logger.info("Initializing database...")
-        init_db()
-    else:
-        hf_api.hf_hub_download(
-            target_repo_id, 'data.db', repo_type='dataset', local_dir='.'
-        )
-        logger.info("Downloaded database")
-
-    chunker = AudioChunker()
-
-    # Get youtube tar files from repo
-    tar_files = hf_api.list_repo_files(repo_id, repo_type='dataset')
-    tar_files = [f for f in tar_files if f.startswith('youtube') and f.endswith('.tar.gz')]
-    logger.info(f"Found {len(tar_files)} tar.gz files in repository {repo_id}.")
-    tar_files = [list(group) for _, group in groupby(sorted(tar_files), key=get_channel_id)]
-
-    for channel_tar_files in tar_files:
-        makedirs(tmp_dir, exist_ok=True)
-
-        # download and extract channel tar files
-        channel_id = download_and_extract_tar_file(channel_tar_files)
-        if not channel_id:
-            logger.info(f'Already processed {channel_id}. Skipping.')
-            continue
-
-        # process channel videos
-        for vid_id in listdir(join(tmp_dir, channel_id)):
-            vid_files = listdir(join(tmp_dir, channel_id, vid_id))
-            
+class YouTubeSource(SourceAdapter):
+    name = 'youtube'
+    repo_id = 'farsi-asr/farsi-asr-dataset'
+    target_repo_id = 'farsi-asr/farsi-youtube-asr-dataset'
+
+    def list_units(self, hub):
+        tar_files = hub.list_repo_files(self.repo_id, repo_type='dataset')
+        tar_files = [f for f in tar_files if f.startswith('youtube') and f.endswith('.tar.gz')]
+        logger.info(f"Found {len(tar_files)} tar.gz files in repository {self.repo_id}.")
+        return [Unit(channel_id, list(group)) for channel_id, group in groupby(sorted(tar_files), key=get_channel_id)]
+
+    def is_uploaded(self, unit, target_files):
+        return super().is_uploaded(unit, target_files) or f'{unit.id}.tar.gz' in target_files
+
+    def fetch(self, hub, unit, work_dir):
+        for tar_file in unit.files:
+            try:
+                tar_path = self.download_file(hub, tar_file, work_dir)
+                logger.info(f"Downloaded {tar_file}")
+            except Exception as e:
+                logger.error(f"Error downloading {tar_file}: {e}")
+                continue
+
+            try:
+                with tarfile.open(tar_path, 'r:gz') as tar:
+                    tar.extractall(work_dir)
+                logger.info(f"Extracted {tar_file} into {work_dir}")
+            except Exception as e:
+                logger.error(f"Error extracting {tar_file}: {e}")
+                continue
+            finally:
+                # only the extracted files are needed from here on
+                remove(tar_path)
+
+        channel_dir = join(work_dir, unit.id)
+        media = []
+        for vid_id in listdir(channel_dir):
+            vid_files = listdir(join(channel_dir, vid_id))
+
             sub_file = [f for f in vid_files if f.endswith('.vtt')]
             audio_file = [f for f in vid_files if f.endswith('.opus')]
 
@@ -135,51 +61,22 @@ if __name__ == '__main__':
                 logger.error(f"Missing subtitles or audio file for video {vid_id}")
                 continue
 
-            sub_path = join(tmp_dir, channel_id, vid_id, sub_file[0])
-            audio_path = join(tmp_dir, channel_id, vid_id, audio_file[0])
+            sub_path = join(channel_dir, vid_id, sub_file[0])
+            audio_path = join(channel_dir, vid_id, audio_file[0])
+            media.append(Media(basename(sub_path).split('.')[0], audio_path, sub_path))
 
-            vid_id = basename(sub_path).split('.')[0]
-            logger.info(f"Processing video ID: {vid_id}")
+        return media
 
-            with get_db_session() as session:
-                if chunk_exists(session, vid_id, 'youtube'):
-                    logger.info(f"Video {vid_id} already processed. Skipping.")
-                    continue
+    def stream(self, hub, unit, work_dir):
+        # audio and subtitles of a video share its directory in the tar
+        pairs = stream_tar_pairs(open_tar_files(hub, self.repo_id, unit.files), work_dir,
+                                 audio_ext='.opus', sub_ext='.vtt', key=dirname)
+        for audio_path, sub_path in pairs:
+            yield Media(basename(sub_path).split('.')[0], audio_path, sub_path)
 
-            output_dir = join(channel_id, vid_id)
-            makedirs(output_dir, exist_ok=True)
+    def get_captions(self, media):
+        return read_subtitles(media.sub_path)
 
-            captions = get_captions(sub_path)
-            if not captions:
-                logger.warning(f"No captions extracted from {sub_path}.")
-                continue
 
-            processed_captions = chunker.chunk(
-                merge=True,
-                audio_file=audio_path,
-                captions=captions,
-                output_dir=output_dir
-            )
-            logger.info(f"Created {len(processed_captions)} audio chunks for video {vid_id}")
-
-            with get_db_session() as session:
-                create_chunks(session, 'youtube', vid_id, processed_captions)
-            logger.info(f"Recorded processed chunks in the database for video {vid_id}")
-
-        if not isdir(channel_id):
-            shutil.rmtree(tmp_dir, ignore_errors=True)
-            logger.warning(f"No chunks created for channel {channel_id}. Skipping.")
-            continue
-        
-        # create archive and upload to target repo
-        archive_path = shutil.make_archive(channel_id, 'gztar', root_dir='.', base_dir=channel_id)
-        logger.info(f"Created archive {archive_path}")
-
-        upload_archive(archive_path)
-
-        upload_db()
-
-        # cleanup
-        shutil.rmtree(tmp_dir, ignore_errors=True)
-        shutil.rmtree(channel_id, ignore_errors=True)
-        remove(archive_path)
\ No newline at end of file
+if __name__ == '__main__':
+    main(YouTubeSource())